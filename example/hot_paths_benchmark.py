@@ -0,0 +1,109 @@
+#Copyright 2012 Do@. All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are
+#permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this list of
+#      conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice, this list
+#      of conditions and the following disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+#THIS SOFTWARE IS PROVIDED BY Do@ ``AS IS'' AND ANY EXPRESS OR IMPLIED
+#WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+#CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+#ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#The views and conclusions contained in the software and documentation are those of the
+#authors and should not be interpreted as representing official policies, either expressed
+#or implied, of Do@.
+
+'''
+Micro benchmark of the per call overhead of the hot paths: choosing a key for a query, find, save and
+BitmapCounter.add with an IdMapper. Runs against a local redis-server.
+Usage: hot_paths_benchmark.py [numCalls, default 20000] [--debug] [--instrument]
+ --debug turns on the util.DEBUG guarded per call logging, for numbers comparable to before it was guarded
+ --instrument adds an instrumentation sink, to measure the overhead of the timers and counters
+
+@author: dvirsky
+'''
+
+from kickass_redis.patterns.object_store.objects import IndexedObject, KeySpec
+from kickass_redis.patterns.object_store.indexing import UnorderedKey, UniqueKey, OrderedNumericalKey, \
+    OrderedCompoundKey
+from kickass_redis.patterns.object_store.condition import Condition
+from kickass_redis.patterns.bitmap_counter import BitmapCounter, IdMapper
+from kickass_redis import util, instrumentation
+
+import logging
+import time
+import sys
+
+
+class BenchUser(IndexedObject):
+
+    _spec = ('id', 'name', 'email', 'age', 'country')
+    _keySpec = KeySpec(
+        UnorderedKey(prefix='benchusers', fields=('name',)),
+        UniqueKey(prefix='benchusers', fields=('email',)),
+        OrderedNumericalKey(prefix='benchusers', field='age'),
+        OrderedCompoundKey(prefix='benchusers', fields=('country',), orderField='age'),
+    )
+
+
+def bench(name, func, num):
+
+    st = time.time()
+    for i in xrange(num):
+        func(i)
+    elapsed = time.time() - st
+
+    print "%s: %d calls in %.02fs, %.01fus per call" % (name, num, elapsed, 1000000 * elapsed / num)
+
+
+def cleanup(conn):
+
+    for pattern in ('*benchusers*', 'benchuser:*', 'ids:benchuser', ':benchuser:idgen', 'uc:benchevents:*',
+                    'idmap:benchevents', ':idmap:benchevents:idgen'):
+        keys = list(conn.scan_iter(pattern, count=1000))
+        for start in xrange(0, len(keys), 1000):
+            conn.delete(*keys[start:start + 1000])
+
+
+if __name__ == '__main__':
+
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    flags = set(a for a in sys.argv[1:] if a.startswith('--'))
+    num = int(args[0]) if args else 20000
+
+    #the usual production setting: info logging is off
+    logging.basicConfig(level=logging.WARN)
+
+    util.DEBUG = '--debug' in flags
+    if '--instrument' in flags:
+        instrumentation.addSink(instrumentation.HistogramSink())
+    print "DEBUG logging: %s, instrumentation: %s" % (util.DEBUG, instrumentation.isEnabled())
+
+    conn = BenchUser._getConnection('master')
+    cleanup(conn)
+
+    counter = BitmapCounter('benchevents', idMapper=IdMapper('benchevents'))
+    ts = time.time()
+
+    try:
+        conditions = [Condition({'name': 'name%d' % i}) for i in xrange(100)] + \
+                     [Condition({'country': 'c%d' % i, 'age': Condition.Between(10, 20)}) for i in xrange(100)]
+
+        bench('KeySpec.getKey', lambda i: BenchUser._keySpec.getKey(conditions[i % len(conditions)]), num * 10)
+        bench('save', lambda i: BenchUser(name='name%d' % (i % 100), email='user%d@example.com' % i, age=i % 80,
+                                          country='c%d' % (i % 100)).save(), num)
+        bench('find', lambda i: BenchUser.find(conditions[i % len(conditions)]), num)
+        bench('BitmapCounter.add', lambda i: counter.add('user%d' % (i % 5000), ts), num)
+    finally:
+        cleanup(conn)
@@ -0,0 +1,119 @@
+#Copyright 2012 Do@. All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are
+#permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this list of
+#      conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice, this list
+#      of conditions and the following disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+#THIS SOFTWARE IS PROVIDED BY Do@ ``AS IS'' AND ANY EXPRESS OR IMPLIED
+#WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+#CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+#ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#The views and conclusions contained in the software and documentation are those of the
+#authors and should not be interpreted as representing official policies, either expressed
+#or implied, of Do@.
+
+'''
+Benchmark the hash-score UnorderedKey against the exact LexicalKey, for indexing and for lookups.
+Runs against a local redis-server (2.8.9 or higher), and deletes the objects it creates
+
+@author: dvirsky
+'''
+
+from kickass_redis.patterns.object_store.objects import IndexedObject, KeySpec
+from kickass_redis.patterns.object_store.indexing import UnorderedKey, LexicalKey
+from kickass_redis.patterns.object_store.condition import Condition
+from kickass_redis.util import TimeSampler
+
+import random
+import sys
+
+
+class HashedUser(IndexedObject):
+
+    _spec = ('id', 'email')
+
+    _keySpec = KeySpec(
+        UnorderedKey(prefix='bench', fields=('email',))
+    )
+
+
+class UnverifiedHashedUser(IndexedObject):
+
+    _spec = ('id', 'email')
+
+    _keySpec = KeySpec(
+        UnorderedKey(prefix='bench_noverify', fields=('email',), verify=False)
+    )
+
+
+class LexicalUser(IndexedObject):
+
+    _spec = ('id', 'email')
+
+    _keySpec = KeySpec(
+        LexicalKey(prefix='bench', fields=('email',))
+    )
+
+
+def benchmark(cls, emails, lookups):
+
+    with TimeSampler('%s: saving %d objects' % (cls.__name__, len(emails)), callback=report):
+        saved = {}
+        for email in emails:
+            obj = cls(email=email)
+            obj.save()
+            saved[email] = '%s' % obj.id
+
+    with TimeSampler('%s: %d lookups' % (cls.__name__, lookups), callback=report):
+        for i in xrange(lookups):
+            email = random.choice(emails)
+            ids = cls.find(Condition({'email': email}))
+            assert ids == [saved[email]], (email, ids)
+
+    with TimeSampler('%s: %d paged lookups' % (cls.__name__, lookups), callback=report):
+        for i in xrange(lookups):
+            cls.find(Condition({'email': random.choice(emails)}, paging=(0, 1)))
+
+
+def cleanup(cls):
+
+    conn = cls._getConnection('master')
+    name = cls.__name__.lower()
+    ids = conn.zrange('ids:%s' % name, 0, -1)
+    pipe = conn.pipeline(transaction=False)
+    for id in ids:
+        pipe.delete('%s:%s' % (name, id))
+    pipe.delete('ids:%s' % name, ':%s:idgen' % name)
+    for key in cls._keySpec.keys():
+        pipe.delete(key.redisKey())
+    pipe.execute()
+
+
+def report(msg):
+
+    print msg
+
+
+if __name__ == '__main__':
+
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    #every other email is non-ASCII, to check that unicode values index and match as their UTF-8 bytes
+    emails = [(u'\xfcser%d@d\xf6m\xe4in.com' if i % 2 else 'user%d@domain.com') % i for i in xrange(num)]
+
+    for cls in (HashedUser, UnverifiedHashedUser, LexicalUser):
+        try:
+            benchmark(cls, emails, num)
+        finally:
+            cleanup(cls)
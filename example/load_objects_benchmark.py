@@ -0,0 +1,126 @@
+#Copyright 2012 Do@. All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are
+#permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this list of
+#      conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice, this list
+#      of conditions and the following disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+#THIS SOFTWARE IS PROVIDED BY Do@ ``AS IS'' AND ANY EXPRESS OR IMPLIED
+#WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+#CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+#ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#The views and conclusions contained in the software and documentation are those of the
+#authors and should not be interpreted as representing official policies, either expressed
+#or implied, of Do@.
+
+'''
+Benchmark memory and throughput of loading many objects, with plain objects vs. slotted, lazily hydrated ones.
+Runs against a local redis-server. Usage: load_objects_benchmark.py [numObjects, default 1000000]
+
+@author: dvirsky
+'''
+
+from kickass_redis.patterns.object_store.objects import IndexedObject, KeySpec
+
+from multiprocessing import Process, Queue
+import resource
+import time
+import sys
+
+CHUNK = 10000
+
+
+class Event(IndexedObject):
+
+    #no __dict__ here, so the slotted subclass really has none
+    __slots__ = ()
+
+    _spec = ('id', 'userId', 'kind', 'timestamp', 'value')
+    _types = {'id': int, 'userId': int, 'timestamp': int, 'value': float}
+
+
+class PlainEvent(Event):
+
+    pass
+
+
+class SlottedEvent(Event):
+
+    _slotted = True
+
+
+def populate(num):
+    """
+    Write the objects directly in pipelined chunks, saving them one by one would take ages
+    """
+    conn = PlainEvent._getConnection('master')
+    for start in xrange(1, num + 1, CHUNK):
+        pipe = conn.pipeline(transaction=False)
+        for id in xrange(start, min(start + CHUNK, num + 1)):
+            pipe.hmset('plainevent:%d' % id, PlainEvent._encode({'id': id, 'userId': id % 1000, 'kind': 'click',
+                                                                   'timestamp': 1400000000 + id, 'value': id * 0.5}))
+        pipe.execute()
+
+
+def cleanup(num):
+
+    conn = PlainEvent._getConnection('master')
+    for start in xrange(1, num + 1, CHUNK):
+        conn.delete(*['plainevent:%d' % id for id in xrange(start, min(start + CHUNK, num + 1))])
+
+
+def maxRSSMB():
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def load(cls, num, results):
+
+    #slotted objects have a different class name, but should read the same data
+    cls._oredis_name = 'plainevent'
+
+    baseRSS = maxRSSMB()
+    st = time.time()
+    objs = []
+    for start in xrange(1, num + 1, CHUNK):
+        objs.extend(cls.loadObjects(range(start, min(start + CHUNK, num + 1))))
+    loadTime = time.time() - st
+
+    st = time.time()
+    total = sum(obj.value for obj in objs)
+    accessTime = time.time() - st
+
+    results.put((cls.__name__, len(objs), loadTime, accessTime, maxRSSMB() - baseRSS))
+
+
+if __name__ == '__main__':
+
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    print "Populating %d objects..." % num
+    populate(num)
+
+    try:
+        results = Queue()
+        for cls in (PlainEvent, SlottedEvent):
+            #each run gets its own process, so memory measurements don't mix
+            p = Process(target=load, args=(cls, num, results))
+            p.start()
+            name, loaded, loadTime, accessTime, rss = results.get()
+            p.join()
+
+            print "%s: loaded %d objects in %.02fs (%.0f objects/sec), accessed a field of all in %.02fs, " \
+                  "memory used: %.01fMB" % (name, loaded, loadTime, loaded / loadTime, accessTime, rss)
+    finally:
+        cleanup(num)
@@ -2,7 +2,7 @@ __author__ = 'dvirsky'
 
 
 import redis
-from kickass_redis.patterns.lua import LuaCall, LuaScriptError
+from kickass_redis.patterns.lua import LuaCall, LuaScriptError, defaultRegistry
 
 #A lua script that multiplies two numbers and stores the result in a key
 
@@ -19,3 +19,10 @@ mult = LuaCall(lua_str, conn)
 print "Result: %s" % mult(keys = ('foor',), args = (3,10))
 
 print "Result: %s" % mult(keys = ('foor2',), args = (5,20))
+
+#Queue many calls in a pipeline - they are all sent in one round-trip, and reloaded if redis lost the script
+pipe = conn.pipeline(transaction=False)
+for i in xrange(10):
+    mult(keys = ('foor%d' % i,), args = (i, 10), conn = pipe)
+
+print "Results: %s" % defaultRegistry.execute(pipe)
@@ -1,4 +1,4 @@
 __author__ = 'dvirsky'
 
-__all__ = ['util', 'patterns']
+__all__ = ['util', 'instrumentation', 'patterns']
 
@@ -0,0 +1,303 @@
+#Copyright 2012 Do@. All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are
+#permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this list of
+#      conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice, this list
+#      of conditions and the following disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+#THIS SOFTWARE IS PROVIDED BY Do@ ``AS IS'' AND ANY EXPRESS OR IMPLIED
+#WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+#CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+#ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#The views and conclusions contained in the software and documentation are those of the
+#authors and should not be interpreted as representing official policies, either expressed
+#or implied, of Do@.
+
+"""
+Instrumentation of the library's hot paths.
+Operations report timings, counters and value distributions to pluggable sinks. With no sinks registered (the default) instrumented
+calls only pay for checking an empty list.
+Example:
+>>> from kickass_redis import instrumentation
+>>> histograms = instrumentation.HistogramSink()
+>>> instrumentation.addSink(histograms)
+>>> ... run some code ...
+>>> print histograms.summary()
+"""
+from __future__ import absolute_import
+__author__ = 'dvirsky'
+
+from contextlib import contextmanager
+from functools import wraps
+import logging
+import random
+import socket
+import time
+
+import redis
+
+
+#the registered sinks. instrumentation is disabled while this is empty
+_sinks = []
+
+
+def addSink(sink):
+    """
+    Register a sink to receive timings and counters
+    """
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def removeSink(sink):
+
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def isEnabled():
+
+    return bool(_sinks)
+
+
+def timing(name, ms):
+    """
+    Report the duration of an operation, in milliseconds
+    """
+    for sink in _sinks:
+        sink.timing(name, ms)
+
+
+def histogram(name, value):
+    """
+    Report a sample of a distribution that is not a duration, e.g. how many commands a pipeline sent
+    """
+    for sink in _sinks:
+        sink.histogram(name, value)
+
+
+def count(name, value = 1):
+    """
+    Increment a counter
+    """
+    for sink in _sinks:
+        sink.count(name, value)
+
+
+def timed(name):
+    """
+    Decorator that reports the duration of each call of a function under a name
+    """
+    def decorator(func):
+
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+
+            st = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timing(name, 1000 * (time.time() - st))
+
+        return wrapped
+
+    return decorator
+
+
+@contextmanager
+def timer(name):
+    """
+    Context manager version of timed, for blocks of code
+    """
+    if not _sinks:
+        yield
+        return
+
+    st = time.time()
+    try:
+        yield
+    finally:
+        timing(name, 1000 * (time.time() - st))
+
+
+class InstrumentedConnection(redis.Connection):
+    """
+    A redis connection that counts round-trips, bytes sent and commands per pipeline.
+    The connection pools of Rediston objects use it by default
+    """
+
+    def send_packed_command(self, command):
+
+        if _sinks:
+            count('redis.roundtrips')
+            if isinstance(command, str):
+                count('redis.bytes_sent', len(command))
+            else:
+                count('redis.bytes_sent', sum(len(c) for c in command))
+
+        return redis.Connection.send_packed_command(self, command)
+
+    def pack_commands(self, commands):
+
+        if _sinks:
+            histogram('redis.pipeline.commands', len(commands))
+
+        return redis.Connection.pack_commands(self, commands)
+
+
+class LoggingSink(object):
+    """
+    Writes every timing, counter and histogram value to a logger
+    """
+
+    def __init__(self, logger = None, level = logging.DEBUG):
+
+        self.logger = logger or logging.getLogger('kickass_redis.instrumentation')
+        self.level = level
+
+    def timing(self, name, ms):
+
+        self.logger.log(self.level, "%s: %.03fms", name, ms)
+
+    def histogram(self, name, value):
+
+        self.logger.log(self.level, "%s: %s", name, value)
+
+    def count(self, name, value):
+
+        self.logger.log(self.level, "%s: +%s", name, value)
+
+
+class StatsdSink(object):
+    """
+    Sends timings, counters and histograms to a statsd server over UDP
+    """
+
+    def __init__(self, host = 'localhost', port = 8125, prefix = 'kickass_redis', sampleRate = 1.0):
+        """
+        @param sampleRate the fraction of the events to send. statsd scales the counters back up
+        """
+        self.addr = (host, port)
+        self.prefix = prefix
+        self.sampleRate = sampleRate
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, kind):
+
+        if self.sampleRate < 1.0:
+            if random.random() >= self.sampleRate:
+                return
+            msg = '%s.%s:%s|%s|@%s' % (self.prefix, name, value, kind, self.sampleRate)
+        else:
+            msg = '%s.%s:%s|%s' % (self.prefix, name, value, kind)
+
+        try:
+            self.sock.sendto(msg, self.addr)
+        except socket.error:
+            #metrics should never break the application
+            pass
+
+    def timing(self, name, ms):
+
+        self._send(name, '%.03f' % ms, 'ms')
+
+    def histogram(self, name, value):
+
+        self._send(name, value, 'h')
+
+    def count(self, name, value):
+
+        self._send(name, value, 'c')
+
+
+class HistogramSink(object):
+    """
+    Keeps counters, and a bounded random sample of the timings and histogram values of each operation, in memory.
+    Call counts, means and maxima are tracked over all the values, not just the sample
+    """
+
+    def __init__(self, maxSamples = 10000):
+        """
+        @param maxSamples how many values to keep per operation (reservoir sampling)
+        """
+        self.maxSamples = maxSamples
+        self.reset()
+
+    def reset(self):
+
+        self.counters = {}
+        self.samples = {}
+        self.calls = {}
+        self.totals = {}
+        self.maxima = {}
+        #names reported through histogram() rather than timing(), so they are summarized apart from durations
+        self.histograms = set()
+
+    def _add(self, name, value):
+
+        n = self.calls.get(name, 0) + 1
+        self.calls[name] = n
+        self.totals[name] = self.totals.get(name, 0) + value
+        self.maxima[name] = max(self.maxima.get(name, value), value)
+        samples = self.samples.setdefault(name, [])
+        if len(samples) < self.maxSamples:
+            samples.append(value)
+        else:
+            idx = random.randint(0, n - 1)
+            if idx < self.maxSamples:
+                samples[idx] = value
+
+    def timing(self, name, ms):
+
+        self._add(name, ms)
+
+    def histogram(self, name, value):
+
+        self.histograms.add(name)
+        self._add(name, value)
+
+    def count(self, name, value):
+
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def percentile(self, name, p):
+
+        samples = sorted(self.samples.get(name, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(p / 100.0 * len(samples)))]
+
+    def summary(self):
+        """
+        @return a dict of counters, and of {calls, mean, p50, p95, p99, max} per timed operation and per histogram
+        """
+        timings = {}
+        histograms = {}
+        for name in self.samples:
+            stats = {
+                'calls': self.calls[name],
+                'mean': float(self.totals[name]) / self.calls[name],
+                'p50': self.percentile(name, 50),
+                'p95': self.percentile(name, 95),
+                'p99': self.percentile(name, 99),
+                'max': self.maxima[name],
+            }
+            if name in self.histograms:
+                histograms[name] = stats
+            else:
+                timings[name] = stats
+
+        return {'counters': dict(self.counters), 'timings': timings, 'histograms': histograms}
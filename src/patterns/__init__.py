@@ -1,2 +1,2 @@
 __author__ = 'dvirsky'
-__all__ = ['object_store', 'bitmap_conter', 'idgenerator', 'lua', 'redis_unit']
+__all__ = ['object_store', 'bitmap_conter', 'idgenerator', 'lua', 'redis_unit', 'redis_profiler']
@@ -27,16 +27,225 @@ from __future__ import absolute_import
 
 from ..object_store.objects import  IndexedObject, KeySpec
 from ..object_store.indexing import *
+from ..lua import LuaCall
+from ...util import generateRandomId
+from redis.exceptions import RedisError
+from threading import Lock, Thread, Event
+import logging
 import math
 import random
+import time
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+#Select an option for each of several tests and count the plays, atomically and in a single round-trip.
+#All the keys are declared: KEYS[1] is the testId index of the options, then each test's bandit key followed by the
+#keys of the options the client believes the test has. ARGV is a random seed, epsilon, the hash fields the bandits'
+#algo and benchmarkLen and the options' playCount, reward and name are stored under, and for each test its id and
+#number of options. If the options of any test changed, nothing is played, and {'stale', ids per test} is returned.
+#Otherwise {'ok', ...} with the option's id, name, new playCount and reward for each test, or nil for tests with no options
+_selectOptions = LuaCall("""
+math.randomseed(tonumber(ARGV[1]))
+local epsilon = tonumber(ARGV[2])
+local algoField, benchmarkLenField = ARGV[3], ARGV[4]
+local playsField, rewardField, nameField = ARGV[5], ARGV[6], ARGV[7]
+
+local function normal()
+    return math.sqrt(-2 * math.log(1 - math.random())) * math.cos(2 * math.pi * math.random())
+end
+
+-- Marsaglia and Tsang's method
+local function gamma(shape)
+    if shape < 1 then
+        return gamma(shape + 1) * math.random() ^ (1 / shape)
+    end
+    local d = shape - 1 / 3
+    local c = 1 / math.sqrt(9 * d)
+    while true do
+        local x, v
+        repeat
+            x = normal()
+            v = 1 + c * x
+        until v > 0
+        v = v * v * v
+        local u = 1 - math.random()
+        if u < 1 - 0.0331 * x ^ 4 or math.log(u) < 0.5 * x * x + d * (1 - v + math.log(v)) then
+            return d * v
+        end
+    end
+end
+
+local function pick(banditKey, optionKeys, ids)
+    if #ids == 0 then
+        return false
+    end
+
+    local conf = redis.call('hmget', banditKey, algoField, benchmarkLenField)
+    local algo = conf[1] or 'ucb1'
+    local benchmarkLen = tonumber(conf[2]) or 60
+
+    local plays, rewards, total = {}, {}, 0
+    for i = 1, #ids do
+        local stats = redis.call('hmget', optionKeys[i], playsField, rewardField)
+        plays[i] = tonumber(stats[1]) or 0
+        rewards[i] = tonumber(stats[2]) or 0
+        total = total + plays[i]
+    end
+
+    local best = 1
+    if algo == 'thompson' then
+        local bestScore = -1
+        for i = 1, #ids do
+            local wins = math.max(0, math.min(rewards[i], plays[i]))
+            local a = gamma(1 + wins)
+            local score = a / (a + gamma(1 + plays[i] - wins))
+            if score > bestScore then best, bestScore = i, score end
+        end
+    elseif algo == 'ucb1' then
+        if total < #ids * benchmarkLen then
+            -- the benchmark rounds: play the least played option
+            for i = 2, #ids do
+                if plays[i] < plays[best] then best = i end
+            end
+        else
+            local bestScore = nil
+            for i = 1, #ids do
+                local score = math.huge
+                if plays[i] > 0 then
+                    score = rewards[i] / plays[i] + math.sqrt(2 * math.log(total) / plays[i])
+                end
+                if bestScore == nil or score > bestScore then best, bestScore = i, score end
+            end
+        end
+    elseif math.random() < epsilon then
+        best = math.floor(math.random() * #ids) + 1
+    else
+        local bestScore = -1
+        for i = 1, #ids do
+            local score = 0
+            if plays[i] > 0 then score = rewards[i] / plays[i] end
+            if score > bestScore then best, bestScore = i, score end
+        end
+    end
+
+    local key = optionKeys[best]
+    local playCount = redis.call('hincrby', key, playsField, 1)
+    return {ids[best], redis.call('hget', key, nameField), playCount, rewards[best]}
+end
+
+-- check the options of all the tests before playing any of them
+local tests, stale, current = {}, false, {}
+local k = 2
+for i = 8, #ARGV, 2 do
+    local ids = redis.call('zrangebyscore', KEYS[1], ARGV[i], ARGV[i])
+    local n = tonumber(ARGV[i + 1])
+    local optionKeys = {}
+    for j = 1, n do
+        optionKeys[j] = KEYS[k + j]
+    end
+    if #ids ~= n then
+        stale = true
+    else
+        for j = 1, n do
+            if string.sub(optionKeys[j], -string.len(ids[j]) - 1) ~= ':' .. ids[j] then
+                stale = true
+            end
+        end
+    end
+    current[#current + 1] = ids
+    tests[#tests + 1] = {KEYS[k], optionKeys, ids}
+    k = k + n + 1
+end
+
+if stale then
+    return {'stale', unpack(current)}
+end
+
+local res = {'ok'}
+for i, test in ipairs(tests) do
+    res[i + 1] = pick(test[1], test[2], test[3])
+end
+return res
+""")
+
+
+#below this many options, numpy's per call overhead is more than it saves
+NUMPY_MIN_OPTIONS = 16
+
+
+def chooseOption(algo, plays, rewards, benchmarkLen, epsilon = 0.1):
+    """
+    Choose an option by the stats of all the options, the same way the selection script does.
+    Scoring is vectorized with numpy if it is installed and there are enough options
+    @param algo one of the Bandit.ALGO_* algorithms
+    @param plays the play counts of the options
+    @param rewards the rewards of the options
+    @return the index of the chosen option
+    """
+    n = len(plays)
+
+    if algo == Bandit.ALGO_EPSILON_GREEDY and random.random() < epsilon:
+        return random.randrange(n)
+
+    if algo == Bandit.ALGO_UCB1 and sum(plays) < n * benchmarkLen:
+        #the benchmark rounds: play the least played option
+        return min(xrange(n), key = plays.__getitem__)
+
+    if numpy is not None and n >= NUMPY_MIN_OPTIONS:
+        scores = _numpyScores(algo, numpy.asarray(plays, dtype = float), numpy.asarray(rewards, dtype = float))
+        return int(numpy.argmax(scores))
+
+    if algo == Bandit.ALGO_THOMPSON:
+        scores = []
+        for p, r in zip(plays, rewards):
+            wins = max(0, min(r, p))
+            scores.append(random.betavariate(1 + wins, 1 + p - wins))
+
+    elif algo == Bandit.ALGO_UCB1:
+        total = sum(plays)
+        if not total:
+            #nothing was played yet, so the log of the total is undefined. play the first option, like the script
+            return 0
+        logTotal = math.log(total)
+        scores = [float(r) / p + math.sqrt(2 * logTotal / p) if p else float('inf') for p, r in zip(plays, rewards)]
+
+    else:
+        scores = [float(r) / p if p else 0 for p, r in zip(plays, rewards)]
+
+    return max(xrange(n), key = scores.__getitem__)
+
+
+def _numpyScores(algo, plays, rewards):
+    """
+    Score options by arrays of their stats. the arrays can also be 2 dimensional, one row per test
+    """
+    if algo == Bandit.ALGO_THOMPSON:
+        wins = numpy.clip(rewards, 0, plays)
+        return numpy.random.beta(1 + wins, 1 + plays - wins)
+
+    played = numpy.maximum(plays, 1)
+    if algo == Bandit.ALGO_UCB1:
+        logTotal = numpy.log(numpy.maximum(plays.sum(axis = -1, keepdims = True), 1))
+        return numpy.where(plays > 0, rewards / played + numpy.sqrt(2 * logTotal / played), numpy.inf)
+
+    return numpy.where(plays > 0, rewards / played, 0)
 
 
 class Option(IndexedObject):
 
     _spec = ('id', 'name', 'playCount', 'reward', 'testId')
 
+    _types = {'id': int, 'playCount': int, 'reward': int, 'testId': int}
+
+    _testIdKey = OrderedNumericalKey('opt', 'testId')
+
     _keySpec = KeySpec(
-        OrderedNumericalKey('opt', 'testId'),
+        _testIdKey,
         UnorderedKey('opt', ('name','testId'))
     )
 
@@ -44,9 +253,9 @@ class Option(IndexedObject):
 
         IndexedObject.__init__(self,
                                 name = name,
-                                playCount = int(playCount),
-                                reward = int(reward),
-                                testId = int(testId),
+                                playCount = playCount,
+                                reward = reward,
+                                testId = testId,
                                 **kwargs)
 
     @classmethod
@@ -57,10 +266,16 @@ class Option(IndexedObject):
 
 class Bandit(IndexedObject):
 
-    _spec = ('id', 'name', 'benchmarkLen')
+    _spec = ('id', 'name', 'algo', 'benchmarkLen')
+
+    _types = {'id': int, 'benchmarkLen': int}
 
     ALGO_UCB1 = 'ucb1'
     ALGO_EPSILON_GREEDY = 'epsgreedy'
+    ALGO_THOMPSON = 'thompson'
+
+    #how often epsilon greedy explores a random option
+    EPSILON = 0.1
 
     def __init__(self, name, algo = ALGO_UCB1, benchmarkLen = 60, **kwargs):
 
@@ -68,16 +283,10 @@ class Bandit(IndexedObject):
         IndexedObject.__init__(self,
                                 algo = algo,
                                 name = name,
-                                benchmarkLen = int(benchmarkLen),
+                                benchmarkLen = benchmarkLen,
                                 **kwargs)
         self.options = []
 
-        #set the algorithm
-        if algo == self.ALGO_UCB1:
-            self.algo = self._ucb1
-        else:
-            self.algo = self._epsilon_greedy
-
 
     def addOption(self, name):
 
@@ -90,100 +299,289 @@ class Bandit(IndexedObject):
         if not noCache and self.options:
             return len(self.options)
 
-        self.options = Option.get(Condition({'testId': self.id}))
+        self.options = [opt for opt in Option.get(Condition({'testId': self.id})) if opt is not None]
 
         return len(self.options)
 
 
-    def selectOptionByScore(self,noCache = True):
+    def selectOptionByScore(self, noCache = True):
+        """
+        Select an option and count the play. This is done by a lua script that reads the stats of all the options,
+        scores them and increments the winner's playCount atomically, in a single round-trip
+        @param noCache ignored, the script always uses the current stats of all the options
+        @return the selected option, with its updated playCount
+        """
 
-        if not self.loadOptions(noCache):
+        selected = self.selectMany((self.id,))[0]
+        if selected is None:
             raise RuntimeError("Could not load any options for test %s" % self)
 
-
-        self.totalPlays = sum((opt.playCount for opt in self.options))
-        selected = max(self.options, key = self.algo)
-
-        #increment option playcount
-        selected.update(playCount = selected.playCount + 1)
         return selected
 
+    #test id => the ids of its options, as the testId index returns them. the selection script tells us when it's stale
+    _optionIds = {}
 
-
-    def rewardOption(self, option, amount = 1):
-
-        option.update(reward = option.reward + amount)
-
-
-
-    def _ucb1(self, option):
-        '''
-        the actual ucb1 algorithm doesn't start before the preliminary benchmark is done,
-        will keep pop options from a list, according to the definition done using init_test,
-        until the list if empty.
-        after benchmarking, will return the option with the current max ucb score.
-        '''
-
-        #for the benchmark rounds - just find the option with the smallest playCount
-        if self.totalPlays < len(self.options) * self.benchmarkLen:
-            return -option.playCount
-
-        avg_score = float(option.reward) / option.playCount
-        return avg_score + math.sqrt(2*math.log(self.totalPlays) / float(option.playCount))
-
-    def _epsilon_greedy(self,  option):
-        '''
-        naive bandit implementation, will always explore 10% of the times.
-        '''
-        choice = None
-        #sometimes... you just want a random option, man
-        if random.random() < 0.1:
-            return random.randint(0, len(self.options)**2)
-
-        else:
-
-            return (float(option.reward) / option.playCount) if option.playCount else 0
-
-
-
-if __name__ == '__main__':
-
-    bandito = Bandit.createNew(name = 'test_foo%d' % random.randint(1, 1000000000),
-                                algo=Bandit.ALGO_EPSILON_GREEDY,
-                                benchmarkLen=100)
-
-
-    for i in xrange(3):
-
-        bandito.addOption('option_%d' % i)
-
-
-    rounds = 0
-    import time
-    while rounds < 10000:
-
-        option = bandito.selectOptionByScore(noCache = True)
-
-
-        r = random.randint(1,10)
-
-        idx = bandito.options.index(option) + 2
-
-        if r%idx ==0 or r % 3 == 0:
-            #print "Rewarding option %d" % (idx - 1)
-
-            bandito.rewardOption(option, 1)
-
-
-
-        if rounds == bandito.benchmarkLen or rounds % 1000 == 0:
-            print "After %d rounds" % rounds
-            for option in bandito.options:
-                print option
-            print "-----------------------------------"
-
-        rounds += 1
-
+    @classmethod
+    def selectMany(cls, testIds):
+        """
+        Select an option for each of many tests, counting the plays, in a single round-trip.
+        Each test is scored with the algorithm and benchmarkLen saved in its bandit
+        @param testIds the ids of the bandits
+        @return a list of the selected options aligned with testIds, with None for tests that have no options
+        """
+        testIds = tuple(testIds)
+        fields = cls._hashFields(('algo', 'benchmarkLen')) + Option._hashFields(('playCount', 'reward', 'name'))
+
+        #the option ids are only learned from the script when ours are missing or stale, so this usually runs once
+        for attempt in xrange(3):
+            keys = [Option._testIdKey.redisKey()]
+            args = [random.randint(1, 2 ** 30), cls.EPSILON] + fields
+            for testId in testIds:
+                ids = cls._optionIds.get(testId, ())
+                keys.append(cls._objectKey(testId))
+                keys.extend(Option._objectKey(id) for id in ids)
+                args.extend((testId, len(ids)))
+
+            res = _selectOptions(keys = keys, args = args, conn = Option._getConnection('master'))
+            if res[0] == 'ok':
+                return [Option(id = int(r[0]), name = r[1], playCount = int(r[2]), reward = int(r[3]),
+                               testId = int(testId)) if r else None for testId, r in zip(testIds, res[1:])]
+
+            for testId, ids in zip(testIds, res[1:]):
+                cls._optionIds[testId] = tuple(ids)
+
+        raise RuntimeError("The options of tests %s keep changing" % (testIds,))
 
 
+    def rewardOption(self, option, amount = 1):
+        """
+        Add to the reward of an option. the increment is done in redis, so concurrent rewards are never lost
+        """
+        option.reward = Option._getConnection('master').hincrby(Option._objectKey(option.id),
+                                                                Option._hashFields(('reward',))[0], amount)
+
+
+
+#Apply a batch of play and reward deltas once, and return the global stats of the options.
+#KEYS[1] marks the batch as applied, so a batch retried after an unknown outcome is not counted twice. the rest are
+#the options' keys. ARGV is the playCount and reward hash fields, the marker's TTL, and plays and rewards per option
+_flushDeltas = LuaCall("""
+if redis.call('exists', KEYS[1]) == 0 then
+    for i = 2, #KEYS do
+        redis.call('hincrby', KEYS[i], ARGV[1], ARGV[2 * i])
+        redis.call('hincrby', KEYS[i], ARGV[2], ARGV[2 * i + 1])
+    end
+    redis.call('set', KEYS[1], 1, 'EX', ARGV[3])
+end
+
+local res = {}
+for i = 2, #KEYS do
+    local stats = redis.call('hmget', KEYS[i], ARGV[1], ARGV[2])
+    res[#res + 1] = tonumber(stats[1]) or 0
+    res[#res + 1] = tonumber(stats[2]) or 0
+end
+return res
+""")
+
+
+class CachedBandit(object):
+    """
+    A bandit that selects options with no network I/O, for high QPS tests.
+    Option stats are kept in process memory. Plays and rewards are counted locally and flushed to redis as deltas
+    by a background thread, every flushInterval seconds or flushEvents events, whichever comes first. Every flush
+    returns the global stats of the flushed options, merged from all the workers, and all the options are reloaded
+    every syncInterval seconds, so the workers converge.
+    A failed flush is logged and retried with backoff. Each batch is applied exactly once, even if a flush failed
+    after redis applied it, and events counted meanwhile wait for the next batch.
+    Example:
+    >>> bandit = CachedBandit(Bandit.loadObjects([testId])[0], flushInterval = 0.5, syncInterval = 5)
+    >>> option = bandit.selectOptionByScore()
+    >>> bandit.rewardOption(option)
+    >>> bandit.stop() # e.g. at shutdown
+    """
+
+    #how long the marker of an applied batch is kept, i.e. the longest a failed batch can be retried for
+    BATCH_MARKER_TTL = 3600
+    #the longest wait between retries of a failed flush, in seconds
+    MAX_BACKOFF = 30.0
+
+    def __init__(self, bandit, flushInterval = 1.0, flushEvents = 1000, syncInterval = 10.0):
+        """
+        @param bandit the Bandit to select for
+        @param flushInterval the longest time, in seconds, plays and rewards are kept locally before being flushed
+        @param flushEvents the most plays and rewards kept locally before a flush is started
+        @param syncInterval the longest time, in seconds, between reloads of all the options' global stats
+        """
+        self.bandit = bandit
+        self.flushInterval = flushInterval
+        self.flushEvents = flushEvents
+        self.syncInterval = syncInterval
+
+        #option id => [plays, rewards] not flushed yet
+        self.pending = {}
+        self.pendingEvents = 0
+        self.lastSync = time.time() if bandit.options else 0
+
+        #the batch being flushed, kept until it is applied: (marker key, {option id => [plays, rewards]})
+        self.__batch = None
+        self.__token = generateRandomId()
+        self.__seq = 0
+        self.__backoff = 0
+
+        self.__lock = Lock()
+        self.__flushLock = Lock()
+        self.__wakeup = Event()
+        self.__stopped = False
+        self.__thread = Thread(target = self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __countEvent(self, option, plays, rewards):
+
+        delta = self.pending.get(option.id)
+        if delta is None:
+            delta = self.pending[option.id] = [0, 0]
+        delta[0] += plays
+        delta[1] += rewards
+        self.pendingEvents += 1
+        if self.pendingEvents >= self.flushEvents:
+            self.__wakeup.set()
+
+    def __flush(self):
+        """
+        Apply the current batch, or take the pending events as a new one
+        @return True if the batch was applied, or if there was nothing to flush
+        """
+        with self.__flushLock:
+            if self.__batch is None:
+                with self.__lock:
+                    if not self.pending:
+                        return True
+                    self.__seq += 1
+                    self.__batch = (':cachedbandit:%s:%d' % (self.__token, self.__seq), self.pending)
+                    self.pending = {}
+                    self.pendingEvents = 0
+
+            marker, deltas = self.__batch
+            ids = list(deltas)
+            args = Option._hashFields(('playCount', 'reward')) + [self.BATCH_MARKER_TTL]
+            for id in ids:
+                args.extend(deltas[id])
+
+            try:
+                res = _flushDeltas(keys = [marker] + [Option._objectKey(id) for id in ids], args = args,
+                                   conn = Option._getConnection('master'))
+            except RedisError, e:
+                self.__backoff = min(self.MAX_BACKOFF, max(self.flushInterval, self.__backoff * 2))
+                logging.warn("Could not flush the stats of test %s, retrying in %.01fs: %s", self.bandit.id,
+                             self.__backoff, e)
+                return False
+
+            self.__backoff = 0
+
+            #the flush returns the global stats, so our view gets the other workers' plays for free.
+            #events counted since the batch was taken are added back on top of them
+            with self.__lock:
+                self.__batch = None
+                options = {opt.id: opt for opt in self.bandit.options}
+                for idx, id in enumerate(ids):
+                    opt = options.get(id)
+                    if opt is not None:
+                        plays, rewards = self.pending.get(id, (0, 0))
+                        opt.playCount, opt.reward = res[2 * idx] + plays, res[2 * idx + 1] + rewards
+            return True
+
+    def __sync(self):
+        """
+        Reload all the options, including ones added since the last sync
+        """
+        options = Option.get(Condition({'testId': self.bandit.id}))
+
+        with self.__lock:
+            #our events that are not in redis yet
+            unflushed = {}
+            for deltas in ((self.__batch or (None, {}))[1], self.pending):
+                for id, (plays, rewards) in deltas.iteritems():
+                    total = unflushed.setdefault(id, [0, 0])
+                    total[0] += plays
+                    total[1] += rewards
+
+            options = [opt for opt in options if opt is not None]
+            for opt in options:
+                plays, rewards = unflushed.get(opt.id, (0, 0))
+                opt.playCount += plays
+                opt.reward += rewards
+            self.bandit.options = options
+            self.lastSync = time.time()
+
+    def __run(self):
+        """
+        The background thread: flush and sync when they are due, backing off while redis fails
+        """
+        lastFlush = time.time()
+        while not self.__stopped:
+            self.__wakeup.wait(self.__backoff or max(0, self.flushInterval - (time.time() - lastFlush)))
+            self.__wakeup.clear()
+            if self.__stopped:
+                break
+
+            if not self.__flush():
+                continue
+            lastFlush = time.time()
+
+            if lastFlush - self.lastSync >= self.syncInterval:
+                try:
+                    self.__sync()
+                except RedisError, e:
+                    logging.warn("Could not reload the options of test %s: %s", self.bandit.id, e)
+
+    def flush(self):
+        """
+        Flush the local plays and rewards to redis now
+        @return True if everything counted so far was flushed
+        """
+        #a batch that failed before is flushed first, then the events counted since
+        return self.__flush() and self.__flush()
+
+    def stop(self):
+        """
+        Stop the background thread and flush what is left, e.g. at shutdown
+        @return True if everything was flushed
+        """
+        self.__stopped = True
+        self.__wakeup.set()
+        self.__thread.join()
+        return self.flush()
+
+    def selectOptionByScore(self):
+        """
+        Select an option by the local view of the stats, and count the play locally
+        @return the selected option. NOTE: its stats are shared with the local view, do not change them
+        """
+        if not self.lastSync:
+            #the first load is the only redis call made on the request path
+            self.__sync()
+
+        with self.__lock:
+            bandit = self.bandit
+            if not bandit.options:
+                raise RuntimeError("Could not load any options for test %s" % bandit)
+
+            idx = chooseOption(bandit.algo, [opt.playCount for opt in bandit.options],
+                               [opt.reward for opt in bandit.options], bandit.benchmarkLen, bandit.EPSILON)
+            selected = bandit.options[idx]
+
+            selected.playCount += 1
+            self.__countEvent(selected, 1, 0)
+            return selected
 
+    def rewardOption(self, option, amount = 1):
+        """
+        Add to the reward of an option locally
+        """
+        with self.__lock:
+            for opt in self.bandit.options:
+                if opt.id == option.id:
+                    opt.reward += amount
+                    break
+            self.__countEvent(option, 0, amount)
@@ -0,0 +1,229 @@
+#Copyright 2012 Do@. All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are
+#permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this list of
+#      conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice, this list
+#      of conditions and the following disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+#THIS SOFTWARE IS PROVIDED BY Do@ ``AS IS'' AND ANY EXPRESS OR IMPLIED
+#WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+#CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+#ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#The views and conclusions contained in the software and documentation are those of the
+#authors and should not be interpreted as representing official policies, either expressed
+#or implied, of Do@.
+
+"""
+Offline simulation and benchmarking of the bandit algorithms, to choose an algorithm and a benchmarkLen for a test
+without touching production.
+
+The simulation runs the algorithms against options with known Bernoulli reward rates, with the stats kept in memory,
+vectorized with numpy over many independent runs. It reports the mean cumulative regret over the rounds and the
+simulated selections per second:
+
+    python -m kickass_redis.patterns.algorithms.bandit_simulation simulate --rates 0.05,0.06,0.08 --runs 1000
+
+The redis mode benchmarks end to end selection latency against a local redis-server instead:
+
+    python -m kickass_redis.patterns.algorithms.bandit_simulation redis --selections 10000
+"""
+
+from __future__ import absolute_import
+
+import argparse
+import random
+import sys
+import time
+
+import numpy
+
+from ..object_store.condition import Condition
+from .bandit import Bandit, CachedBandit, Option, _numpyScores
+
+
+class Simulation(object):
+    """
+    Simulates many independent runs of one algorithm at once. the stats of all the runs are kept in
+    (runs x options) arrays, and each round selects and rewards an option in every run
+    """
+
+    def __init__(self, rates, algo, benchmarkLen = 60, epsilon = Bandit.EPSILON, runs = 1000, seed = None):
+        """
+        @param rates the true reward probabilities of the options
+        @param algo one of the Bandit.ALGO_* algorithms
+        @param runs how many independent runs to simulate
+        @param seed seed the random generator, for reproducible results
+        """
+        self.rates = numpy.asarray(rates, dtype = float)
+        self.algo = algo
+        self.benchmarkLen = benchmarkLen
+        self.epsilon = epsilon
+        self.runs = runs
+
+        if seed is not None:
+            numpy.random.seed(seed)
+
+        self.plays = numpy.zeros((runs, len(rates)))
+        self.rewards = numpy.zeros((runs, len(rates)))
+        self.rounds = 0
+
+    def choose(self):
+        """
+        Choose an option in every run, the same way chooseOption does
+        @return an array of the option index chosen in each run
+        """
+        numOptions = len(self.rates)
+
+        #all runs play once per round, so they are all in the benchmark rounds or none are
+        if self.algo == Bandit.ALGO_UCB1 and self.rounds < numOptions * self.benchmarkLen:
+            return numpy.argmin(self.plays, axis = 1)
+
+        choices = numpy.argmax(_numpyScores(self.algo, self.plays, self.rewards), axis = 1)
+
+        if self.algo == Bandit.ALGO_EPSILON_GREEDY:
+            explore = numpy.random.random(self.runs) < self.epsilon
+            choices[explore] = numpy.random.randint(0, numOptions, explore.sum())
+
+        return choices
+
+    def run(self, rounds):
+        """
+        Run the simulation for a number of rounds
+        @return an array of the mean cumulative regret after each round
+        """
+        regret = numpy.zeros(rounds)
+        best = self.rates.max()
+        runIdx = numpy.arange(self.runs)
+
+        for i in xrange(rounds):
+            choices = self.choose()
+            chosenRates = self.rates[choices]
+
+            self.plays[runIdx, choices] += 1
+            self.rewards[runIdx, choices] += numpy.random.random(self.runs) < chosenRates
+            self.rounds += 1
+
+            regret[i] = (best - chosenRates).mean()
+
+        return regret.cumsum()
+
+
+def simulate(rates, algos, benchmarkLens, runs, rounds, checkpoints = 10, seed = None, out = sys.stdout):
+    """
+    Simulate every algorithm (and every benchmarkLen for UCB1) and print their regret curves
+    @return a dict of (algo, benchmarkLen) => the regret curve
+    """
+    configs = []
+    for algo in algos:
+        for benchmarkLen in (benchmarkLens if algo == Bandit.ALGO_UCB1 else (None,)):
+            configs.append((algo, benchmarkLen))
+
+    steps = sorted(set(max(1, rounds * (i + 1) // checkpoints) for i in xrange(checkpoints)))
+
+    out.write("%d options with reward rates %s, %d runs of %d rounds\n" % (len(rates), rates, runs, rounds))
+    out.write("%-22s %12s  %s\n" % ('algorithm', 'selections/s', '  '.join('%8d' % s for s in steps)))
+
+    curves = {}
+    for algo, benchmarkLen in configs:
+        sim = Simulation(rates, algo, benchmarkLen or 0, runs = runs, seed = seed)
+
+        st = time.time()
+        curve = sim.run(rounds)
+        elapsed = time.time() - st
+
+        curves[(algo, benchmarkLen)] = curve
+        name = algo if benchmarkLen is None else '%s(%d)' % (algo, benchmarkLen)
+        out.write("%-22s %12.0f  %s\n" % (name, runs * rounds / elapsed,
+                                          '  '.join('%8.1f' % curve[s - 1] for s in steps)))
+
+    return curves
+
+
+def _latencies(func, num):
+
+    latencies = []
+    for _ in xrange(num):
+        st = time.time()
+        func()
+        latencies.append(1000 * (time.time() - st))
+
+    latencies.sort()
+    return latencies
+
+
+def benchmarkRedis(numOptions, selections, tests = 20, out = sys.stdout):
+    """
+    Benchmark end to end selection latency against the redis the object store is configured for:
+    single selections, selectMany for several tests and the locally cached bandit
+    """
+    bandits = []
+    for i in xrange(tests):
+        bandit = Bandit.createNew(name = 'simulation_%d' % random.randint(1, 1000000000), algo = Bandit.ALGO_UCB1,
+                                  benchmarkLen = 10)
+        for j in xrange(numOptions):
+            bandit.addOption('option_%d' % j)
+        bandits.append(bandit)
+
+    testIds = [bandit.id for bandit in bandits]
+    cached = CachedBandit(bandits[0], flushInterval = 0.1, flushEvents = 1000)
+
+    try:
+        runs = (
+            ('selectOptionByScore', bandits[0].selectOptionByScore, selections, 1),
+            ('selectMany(%d)' % tests, lambda: Bandit.selectMany(testIds), max(1, selections // tests), tests),
+            ('CachedBandit', cached.selectOptionByScore, selections, 1),
+        )
+
+        out.write("%-22s %12s %10s %10s %10s\n" % ('mode', 'selections/s', 'p50 ms', 'p99 ms', 'max ms'))
+        for name, func, num, perCall in runs:
+            latencies = _latencies(func, num)
+            out.write("%-22s %12.0f %10.3f %10.3f %10.3f\n" % (name, num * perCall / (sum(latencies) / 1000),
+                                                             latencies[len(latencies) // 2],
+                                                             latencies[int(len(latencies) * 0.99)], latencies[-1]))
+        cached.stop()
+    finally:
+        for bandit in bandits:
+            Option.delete(Condition({'testId': bandit.id}))
+            #bandits have no keys to delete them by
+            pipe = Bandit._getPipeline('master')
+            pipe.delete(Bandit._objectKey(bandit.id))
+            pipe.zrem(Bandit._idsKey(), bandit.id)
+            pipe.execute()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Simulate and benchmark the bandit algorithms")
+    modes = parser.add_subparsers(dest = 'mode')
+
+    sim = modes.add_parser('simulate', help = "offline simulation against synthetic reward rates")
+    sim.add_argument('--rates', default = '0.05,0.06,0.08', help = "comma separated reward rates of the options")
+    sim.add_argument('--algos', default = ','.join((Bandit.ALGO_UCB1, Bandit.ALGO_EPSILON_GREEDY,
+                                                     Bandit.ALGO_THOMPSON)))
+    sim.add_argument('--benchmarkLens', default = '10,60', help = "comma separated benchmarkLens to try for ucb1")
+    sim.add_argument('--runs', type = int, default = 1000)
+    sim.add_argument('--rounds', type = int, default = 10000)
+    sim.add_argument('--seed', type = int, default = None)
+
+    bench = modes.add_parser('redis', help = "benchmark selection latency against a local redis-server")
+    bench.add_argument('--options', type = int, default = 3)
+    bench.add_argument('--selections', type = int, default = 10000)
+    bench.add_argument('--tests', type = int, default = 20)
+
+    args = parser.parse_args()
+    if args.mode == 'simulate':
+        simulate([float(r) for r in args.rates.split(',')], args.algos.split(','),
+                 [int(b) for b in args.benchmarkLens.split(',')], args.runs, args.rounds, seed = args.seed)
+    else:
+        benchmarkRedis(args.options, args.selections, args.tests)
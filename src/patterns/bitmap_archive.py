@@ -0,0 +1,339 @@
+#Copyright 2012 Do@. All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are
+#permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this list of
+#      conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice, this list
+#      of conditions and the following disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+#THIS SOFTWARE IS PROVIDED BY Do@ ``AS IS'' AND ANY EXPRESS OR IMPLIED
+#WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+#CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+#ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#The views and conclusions contained in the software and documentation are those of the
+#authors and should not be interpreted as representing official policies, either expressed
+#or implied, of Do@.
+
+"""
+Tiered storage for BitmapCounter: closed time slots are immutable, so instead of keeping them in redis RAM forever
+they can be moved to local files, one per metric and resolution, with an index of the slots in each file.
+A counter given the archive reads archived slots from it transparently, and hot slots from redis.
+Example:
+>>> archive = BitmapArchive('/var/lib/counters')
+>>> counter = BitmapCounter('dau', timeResolutions=(BitmapCounter.RES_DAY,), archive=archive)
+>>> #run periodically: archive daily slots after a week, and forget them after a year
+>>> archive.archive(counter, {BitmapCounter.RES_DAY: ArchivePolicy(archiveAfter=7 * 86400, keepFor=365 * 86400)})
+"""
+
+from __future__ import absolute_import
+
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import mmap
+import os
+import time
+import zlib
+
+import redis
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+if numpy is not None:
+    #the number of set bits in each byte value
+    _POPCOUNT = numpy.array([bin(i).count('1') for i in xrange(256)], dtype=numpy.int64)
+
+
+def popcount(data):
+    """
+    Count the set bits of a bitmap, given as a string or a numpy uint8 array
+    """
+    if numpy is not None:
+        if isinstance(data, str):
+            data = numpy.frombuffer(data, dtype=numpy.uint8)
+        return int(_POPCOUNT[data].sum())
+
+    return bin(int(data.encode('hex') or '0', 16)).count('1')
+
+
+def bitopCount(op, bitmaps):
+    """
+    Count the set bits of the AND or OR of bitmaps of any length, locally. missing bytes count as zeros, like BITOP
+    @param bitmaps strings or numpy uint8 arrays
+    """
+    length = max(len(b) for b in bitmaps)
+    if not length:
+        return 0
+
+    if numpy is not None:
+        res = numpy.zeros(length, dtype=numpy.uint8)
+        first = bitmaps[0] if not isinstance(bitmaps[0], str) else numpy.frombuffer(bitmaps[0], dtype=numpy.uint8)
+        res[:len(first)] = first
+        for b in bitmaps[1:]:
+            if isinstance(b, str):
+                b = numpy.frombuffer(b, dtype=numpy.uint8)
+            if op == 'AND':
+                res[len(b):] = 0
+                res[:len(b)] &= b
+            else:
+                res[:len(b)] |= b
+        return popcount(res)
+
+    values = [int((b + '\0' * (length - len(b))).encode('hex'), 16) for b in bitmaps]
+    res = values[0]
+    for v in values[1:]:
+        res = res & v if op == 'AND' else res | v
+    return bin(res).count('1')
+
+
+def _orBitmaps(a, b):
+
+    length = max(len(a), len(b))
+    a, b = a.ljust(length, '\0'), b.ljust(length, '\0')
+    if numpy is not None:
+        return (numpy.frombuffer(a, dtype=numpy.uint8) | numpy.frombuffer(b, dtype=numpy.uint8)).tostring()
+    return ''.join(chr(ord(x) | ord(y)) for x, y in zip(a, b))
+
+
+class ArchivePolicy(object):
+    """
+    When to move a resolution's slots to the archive, and when to forget them
+    """
+
+    def __init__(self, archiveAfter, keepFor=None):
+        """
+        @param archiveAfter how long after a slot closes it is archived, in seconds
+        @param keepFor if set, how long after a slot closes it is deleted from redis and from the archive, in seconds
+        """
+        self.archiveAfter = archiveAfter
+        self.keepFor = keepFor
+
+
+class _SlotFile(object):
+    """
+    The archived slots of one metric and resolution: an append only data file, and a json index of
+    slot start => [offset, length, count, compressed]. Writers hold an exclusive lock on a lock file next to them
+    """
+
+    def __init__(self, directory, metric, resolution):
+
+        base = os.path.join(directory, '%s.%s' % (metric, resolution))
+        self.dataPath = base + '.data'
+        self.indexPath = base + '.index'
+        self.lockPath = base + '.lock'
+        self.index = {}
+        self.__mtime = None
+        self.__mmap = None
+        self.__mmapSize = 0
+
+    def refresh(self, force=False):
+        """
+        Reload the index if another process has changed it
+        @param force reload it even if its mtime did not change
+        """
+        try:
+            mtime = os.stat(self.indexPath).st_mtime
+        except OSError:
+            return
+
+        if force or mtime != self.__mtime:
+            with open(self.indexPath) as f:
+                self.index = json.load(f)
+            self.__mtime = mtime
+
+    @contextmanager
+    def locked(self):
+        """
+        Lock the files against other writers, and reload the index, so changes are made to the latest one.
+        The index is replaced on every save, so the lock is on a separate file
+        """
+        with open(self.lockPath, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.refresh(force=True)
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def __data(self, end):
+        """
+        Get a memory map of the data file that covers an offset
+        """
+        if self.__mmap is None or end > self.__mmapSize:
+            with open(self.dataPath, 'rb') as f:
+                self.__mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.__mmapSize = len(self.__mmap)
+        return self.__mmap
+
+    def bitmap(self, start):
+        """
+        Get an archived slot's bitmap. uncompressed slots are read from the memory map without copying if numpy
+        is installed
+        """
+        offset, length, count, compressed = self.index[str(start)]
+        if not length:
+            return ''
+
+        data = self.__data(offset + length)
+        if compressed:
+            return zlib.decompress(data[offset:offset + length])
+        if numpy is not None:
+            return numpy.frombuffer(data, dtype=numpy.uint8, count=length, offset=offset)
+        return data[offset:offset + length]
+
+    def add(self, start, bitmap, compress):
+        """
+        Append a slot's bitmap. a slot that is already archived is merged with the new bitmap
+        """
+        if str(start) in self.index:
+            old = self.bitmap(start)
+            bitmap = _orBitmaps(old if isinstance(old, str) else old.tostring(), bitmap)
+
+        count = popcount(bitmap)
+        data = zlib.compress(bitmap) if compress else bitmap
+        with open(self.dataPath, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.index[str(start)] = [offset, len(data), count, bool(compress)]
+
+    def save(self):
+        """
+        Write the index atomically
+        """
+        tmp = self.indexPath + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.indexPath)
+        self.__mtime = os.stat(self.indexPath).st_mtime
+
+
+class BitmapArchive(object):
+    """
+    A directory of archived BitmapCounter slots
+    """
+
+    def __init__(self, directory, compress=False):
+        """
+        @param directory where the archive files are kept
+        @param compress if True, slots are compressed with zlib. this saves disk space, but they are decompressed on
+        every read instead of being memory mapped
+        """
+        self.directory = directory
+        self.compress = compress
+        self.__files = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __file(self, metric, resolution):
+
+        f = self.__files.get((metric, resolution))
+        if f is None:
+            f = self.__files[(metric, resolution)] = _SlotFile(self.directory, metric, resolution)
+        f.refresh()
+        return f
+
+    def has(self, metric, resolution, start):
+
+        return str(start) in self.__file(metric, resolution).index
+
+    def count(self, metric, resolution, start):
+        """
+        Get the number of members of an archived slot, which is kept in the index
+        """
+        return self.__file(metric, resolution).index[str(start)][2]
+
+    def bitmap(self, metric, resolution, start):
+        """
+        Get the bitmap of an archived slot, as a string or as a numpy uint8 array
+        """
+        return self.__file(metric, resolution).bitmap(start)
+
+    def slots(self, metric, resolution):
+        """
+        Get the start times of the archived slots of a metric and resolution
+        """
+        return sorted(int(s) for s in self.__file(metric, resolution).index)
+
+    def archive(self, counter, policies, now=None):
+        """
+        Move the closed slots of a counter from redis to the archive, and forget expired ones, by per resolution
+        policies. A slot written to while it is being archived stays in redis, and is merged on the next run.
+        Overlapping runs, e.g. from several processes, are safe
+        @param counter a BitmapCounter
+        @param policies a dict of resolution => ArchivePolicy
+        @param now the current time, for testing
+        @return a tuple of (slots archived, slots expired)
+        """
+        now = now or time.time()
+        conn = counter._getConnection()
+        archived = expired = 0
+
+        for resolution, policy in policies.iteritems():
+            f = self.__file(counter.metric, resolution)
+            prefix = counter.getKey(0, resolution).rsplit(':', 1)[0] + ':'
+            forgotten = []
+
+            for key in conn.scan_iter(prefix + '*', count=100):
+                start = int(key[len(prefix):])
+                age = now - (start + resolution)
+                if age < policy.archiveAfter:
+                    continue
+
+                if policy.keepFor is not None and age >= policy.keepFor:
+                    conn.delete(key)
+                    forgotten.append(start)
+                    continue
+
+                with conn.pipeline() as pipe:
+                    try:
+                        pipe.watch(key)
+                        bitmap = pipe.get(key)
+                        if bitmap is None:
+                            continue
+                        with f.locked():
+                            f.add(start, bitmap, self.compress)
+                            f.save()
+
+                        pipe.multi()
+                        pipe.delete(key)
+                        pipe.execute()
+                        archived += 1
+                    except redis.WatchError:
+                        logging.info("Slot %s was written to while being archived, it will be merged next time", key)
+
+            if policy.keepFor is not None:
+                #the space of forgotten slots in the data file is not reclaimed
+                with f.locked():
+                    for start in f.index.keys():
+                        if now - (int(start) + resolution) >= policy.keepFor:
+                            del f.index[start]
+                            forgotten.append(start)
+                    f.save()
+
+            if forgotten:
+                conn.hdel(counter.countKey(resolution), *forgotten)
+                expired += len(forgotten)
+
+        return archived, expired
@@ -0,0 +1,212 @@
+#Copyright 2012 Do@. All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are
+#permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this list of
+#      conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice, this list
+#      of conditions and the following disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+#THIS SOFTWARE IS PROVIDED BY Do@ ``AS IS'' AND ANY EXPRESS OR IMPLIED
+#WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+#CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+#ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#The views and conclusions contained in the software and documentation are those of the
+#authors and should not be interpreted as representing official policies, either expressed
+#or implied, of Do@.
+
+"""
+Offline backfill of BitmapCounter history. Instead of replaying events with add(), one SETBIT round-trip each, the
+events are resolved to sequential ids in bulk, bucketed per time slot with the counter's own snapping, and each slot's
+bitmap is built in a numpy bit array in a process pool and uploaded with a single SET, or merged into the existing
+data with BITOP OR.
+
+    python -m kickass_redis.patterns.bitmap_backfill events.jsonl --metric dau --resolutions 86400,604800 \
+        --idField userId --timeField timestamp --idMapper users --workers 4
+"""
+
+from __future__ import absolute_import
+
+from array import array
+from multiprocessing import Pool
+import argparse
+import csv
+import json
+import logging
+import sys
+import time
+
+import numpy
+
+from ..util import generateRandomId
+from .bitmap_counter import BitmapCounter, IdMapper
+
+
+def readEvents(path, idField, timeField, format=None):
+    """
+    Read (objectId, timestamp) events from a CSV file with a header line, or from a JSON lines file
+    @param format 'csv' or 'jsonl'. guessed from the file extension if not given
+    """
+    format = format or ('csv' if path.endswith('.csv') else 'jsonl')
+
+    with open(path) as f:
+        if format == 'csv':
+            for row in csv.DictReader(f):
+                yield row[idField], float(row[timeField])
+        else:
+            for line in f:
+                if line.strip():
+                    event = json.loads(line)
+                    yield event[idField], float(event[timeField])
+
+
+def _buildBitmap(item):
+    """
+    Build a slot's bitmap from its ids. runs in the worker processes
+    """
+    key, ids = item
+    ids = numpy.frombuffer(ids, dtype=numpy.dtype(ids.typecode))
+    bits = numpy.zeros(ids.max() + 1, dtype=bool)
+    bits[ids] = True
+    #packbits is most significant bit first, just like redis bit offsets
+    return key, numpy.packbits(bits).tostring()
+
+
+class BitmapBackfill(object):
+    """
+    Builds the bitmaps of a counter's slots locally from historical events, and uploads them
+    Example:
+    >>> backfill = BitmapBackfill(BitmapCounter('dau', idMapper=IdMapper('users')), workers=4)
+    >>> backfill.addEvents(readEvents('events.csv', 'userId', 'timestamp'))
+    >>> backfill.upload()
+    """
+
+    def __init__(self, counter, workers=None, replace=False, batchSize=10000):
+        """
+        @param counter the BitmapCounter to backfill. its resolutions and id mapper are used
+        @param workers the number of processes building bitmaps, defaults to the number of cpus
+        @param replace if True, uploaded slots replace the existing ones instead of being merged into them
+        @param batchSize how many events to resolve ids for at a time
+        """
+        self.counter = counter
+        self.workers = workers
+        self.replace = replace
+        self.batchSize = batchSize
+
+        #slot key => array of the sequential ids in it
+        self.slots = {}
+        self.events = 0
+        #the ids already resolved, so each object is only resolved once
+        self.__ids = {}
+
+    def __resolve(self, objectIds):
+
+        if not self.counter.idMapper:
+            return [int(objectId) for objectId in objectIds]
+
+        known = self.__ids
+        new = list(set(objectId for objectId in objectIds if objectId not in known))
+        if new:
+            known.update(zip(new, self.counter.idMapper.getSequentialIds(new)))
+        return [known[objectId] for objectId in objectIds]
+
+    def __addBatch(self, batch):
+
+        ids = numpy.array(self.__resolve([objectId for objectId, _ in batch]), dtype=numpy.dtype('l'))
+        timestamps = numpy.array([timestamp for _, timestamp in batch], dtype=float)
+
+        for res in self.counter.timeResolutions:
+            #the same snapping as getKey, for the whole batch at once
+            starts = (timestamps - numpy.mod(timestamps - self.counter.slotSnap(res), res)).astype(numpy.int64)
+            for start in numpy.unique(starts):
+                key = self.counter.getKey(int(start), res)
+                slot = self.slots.get(key)
+                if slot is None:
+                    slot = self.slots[key] = array('l')
+                slot.fromstring(ids[starts == start].tostring())
+
+        self.events += len(batch)
+
+    def addEvents(self, events):
+        """
+        Add events to the backfill
+        @param events an iterable of (objectId, timestamp) tuples
+        """
+        batch = []
+        for event in events:
+            batch.append(event)
+            if len(batch) >= self.batchSize:
+                self.__addBatch(batch)
+                batch = []
+        if batch:
+            self.__addBatch(batch)
+
+    def upload(self):
+        """
+        Build the bitmaps of all the slots and upload them
+        @return the number of slots uploaded
+        """
+        conn = self.counter._getConnection()
+
+        pool = Pool(self.workers)
+        try:
+            for key, data in pool.imap_unordered(_buildBitmap, self.slots.iteritems()):
+                pipe = conn.pipeline(transaction=False)
+                if self.replace:
+                    pipe.set(key, data)
+                else:
+                    tmp = 'backfill:%s' % generateRandomId()
+                    pipe.set(tmp, data)
+                    pipe.bitop('OR', key, key, tmp)
+                    pipe.delete(tmp)
+                pipe.execute()
+        finally:
+            pool.close()
+            pool.join()
+
+        #the cached counts and retention counts of the backfilled slots are not valid anymore
+        conn.delete(*[self.counter.retentionKey(res) for res in self.counter.timeResolutions] +
+                    [self.counter.countKey(res) for res in self.counter.timeResolutions])
+
+        num = len(self.slots)
+        self.slots = {}
+        return num
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Backfill a BitmapCounter from event logs")
+    parser.add_argument('paths', nargs='+', help="CSV (with a header line) or JSON lines files")
+    parser.add_argument('--metric', required=True)
+    parser.add_argument('--resolutions', default=str(BitmapCounter.RES_DAY), help="comma separated, in seconds")
+    parser.add_argument('--idField', default='id')
+    parser.add_argument('--timeField', default='timestamp')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), default=None)
+    parser.add_argument('--idMapper', default=None, help="the prefix of the IdMapper for non sequential ids")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--replace', action='store_true', help="replace existing slots instead of merging")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    counter = BitmapCounter(args.metric, timeResolutions=tuple(int(r) for r in args.resolutions.split(',')),
+                            idMapper=IdMapper(args.idMapper) if args.idMapper else None)
+    backfill = BitmapBackfill(counter, workers=args.workers, replace=args.replace)
+
+    st = time.time()
+    for path in args.paths:
+        backfill.addEvents(readEvents(path, args.idField, args.timeField, args.format))
+    logging.info("Read %d events in %.02fs", backfill.events, time.time() - st)
+
+    st = time.time()
+    num = backfill.upload()
+    logging.info("Uploaded %d slots in %.02fs", num, time.time() - st)
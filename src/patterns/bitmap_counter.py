@@ -27,11 +27,69 @@ from __future__ import absolute_import
 __author__ = 'dvirsky'
 
 
-from ..util import Rediston, TimeSampler, InstanceCache
+from .. import util
+from ..util import Rediston, TimeSampler, InstanceCache, generateRandomId
+from .. import instrumentation
+from ..instrumentation import timed
 import logging
 import time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from ..patterns.idgenerator import  IncrementalIdGenerator
+from .bitmap_archive import bitopCount, _orBitmaps
+from .lua import LuaCall, defaultRegistry
+
+
+#set a member's bit in each slot, and keep the slots' counts in the counts cache up to date.
+#KEYS are the slot bitmaps, then their counts cache hashes, then their retention cache hashes. ARGV is the member id,
+#then the slots' starts, then a 1 or 0 per slot for whether it is closed.
+#a running count is only incremented if it was seeded. late writes to a closed slot invalidate its stored count, and
+#the retention cells of its resolution, which are only cached for closed slots
+_addMember = LuaCall("""
+local n = #KEYS / 3
+for i = 1, n do
+    if redis.call('setbit', KEYS[i], ARGV[1], 1) == 0 then
+        redis.call('hdel', KEYS[n + i], ARGV[i + 1])
+        if ARGV[n + i + 1] == '1' then
+            redis.call('del', KEYS[2 * n + i])
+        elseif redis.call('hexists', KEYS[n + i], ARGV[i + 1] .. ':open') == 1 then
+            redis.call('hincrby', KEYS[n + i], ARGV[i + 1] .. ':open', 1)
+        end
+    end
+end
+""")
+
+#seed the running count of an open slot, atomically with respect to _addMember
+_seedCount = LuaCall("""
+local count = redis.call('hget', KEYS[2], ARGV[1])
+if not count then
+    count = redis.call('bitcount', KEYS[1])
+    redis.call('hset', KEYS[2], ARGV[1], count)
+end
+return tonumber(count)
+""")
+
+#store the final count of a closed slot and forget its running count, atomically with respect to _addMember.
+#the count is BITCOUNTed, or given by the client in ARGV[2], e.g. merged with the archive, in which case it is only
+#stored if the bitmap still has the ARGV[3] members it was computed with
+_storeCount = LuaCall("""
+local bits = redis.call('bitcount', KEYS[1])
+local count = bits
+if #ARGV > 1 then
+    if bits ~= tonumber(ARGV[3]) then
+        return false
+    end
+    count = tonumber(ARGV[2])
+end
+redis.call('hset', KEYS[2], ARGV[1], count)
+redis.call('hdel', KEYS[2], ARGV[1] .. ':open')
+return count
+""")
+
 
 class BitmapCounter(Rediston):
     """
@@ -57,9 +115,12 @@ class BitmapCounter(Rediston):
     OP_AVG = 'AVG'
     OP_INTERESECT = 'INTERSECT'
 
+    #the counts cache is refreshed whenever counts are read, so only counters nobody reads expire
+    COUNT_CACHE_TTL = 30 * 86400
 
 
-    def __init__(self, metricName, timeResolutions=(86400,), snapWeekTo=SNAP_SUNDAY, timeZone=TZ_GMT, idMapper=None):
+    def __init__(self, metricName, timeResolutions=(86400,), snapWeekTo=SNAP_SUNDAY, timeZone=TZ_GMT, idMapper=None,
+                 archive=None):
         """
         Constructor
         @param metricName the name of the metric we're sampling, to be used as the redis key
@@ -67,6 +128,7 @@ class BitmapCounter(Rediston):
         @param idMapper optional IdMapper object that can convert non sequential ids to sequential ones
         @param snapWeekTo used when a week resolution is set, defines to which day should the timestamp be snapped
         @param timeZone for week snaps, define time zone by difference from GMT in hours
+        @param archive optional BitmapArchive that old slots are moved to. archived slots are read from it transparently
         NOTE: there will be an extra counter key in redis for each resolution, so lots of resolutions can cause huge RAM overhead
         """
         self.metric = metricName
@@ -74,19 +136,61 @@ class BitmapCounter(Rediston):
         self.idMapper = idMapper
         self.snapWeekTo = snapWeekTo
         self.timeZone = timeZone * self.RES_HOUR
+        self.archive = archive
+
+    def slotSnap(self, resolution):
+        """
+        Get the offset time slots of a resolution are snapped to
+        """
+        if resolution == self.RES_WEEK:
+            return self.snapWeekTo - self.timeZone
+        return 0
+
+    def slotStart(self, timestamp, resolution=None):
+        """
+        Get the start time of the time slot a timestamp is in
+        """
+        resolution = resolution or self.timeResolutions[0]
+        return int(timestamp - ((timestamp - self.slotSnap(resolution)) % resolution))
 
     def getKey(self, timestamp, resolution=None):
         """
         Get the redis key for this object, for internal use
         """
-        
-        snap = 0
         resolution = resolution or self.timeResolutions[0]
-        if resolution == self.RES_WEEK:
-            snap = self.snapWeekTo - self.timeZone
-        return 'uc:%s:%s:%s' % (self.metric, resolution, int(timestamp - ((timestamp - snap) % resolution)))
+        return 'uc:%s:%s:%s' % (self.metric, resolution, self.slotStart(timestamp, resolution))
 
+    def countKey(self, resolution=None):
+        """
+        Get the redis key of the hash that caches the counts of a resolution's slots
+        """
+        return 'count:%s:%s' % (self.metric, resolution or self.timeResolutions[0])
 
+    def retentionKey(self, resolution=None):
+        """
+        Get the redis key of the hash that caches the retention matrix cells of a resolution's closed slots
+        """
+        return 'retention:%s:%s' % (self.metric, resolution or self.timeResolutions[0])
+
+    def slot(self, timestamp, resolution=None):
+        """
+        Get the bitmap of a time slot, to be used in set algebra expressions. e.g:
+        >>> (dau.slot(t) & mobile.slot(t)) - churned.slot(t, BitmapCounter.RES_WEEK)
+        NOTE: expressions run in redis, so archived slots can't be used in them
+        @param timestamp any time in the slot
+        @param resolution the slot's resolution, defaults to the first resolution given to the counter
+        """
+        self.__checkNotArchived(timestamp, resolution)
+        return Bitmap(self.getKey(timestamp, resolution), self)
+
+    def __checkNotArchived(self, timestamp, resolution):
+
+        resolution = resolution or self.timeResolutions[0]
+        if self.__archived([timestamp], resolution):
+            raise ValueError("The %s slot of %s at %s is archived, it is not in redis" %
+                             (resolution, self.metric, self.slotStart(timestamp, resolution)))
+
+    @timed('bitmap.add')
     def add(self, objectId, timestamp=None, sequentialIdMappingPrefix=None):
         """
         Add one sample.
@@ -101,13 +205,28 @@ class BitmapCounter(Rediston):
 
         timestamp = timestamp or time.time()
 
-        #get the keys to sample to
+        #get the keys to sample to, and the counts and retention caches of each
         keys = [self.getKey(timestamp, res) for res in self.timeResolutions]
-        pipe = self._getPipeline()
-        #set the bits
-        [pipe.setbit(key, int(objectId), 1) for key in keys]
-        pipe.execute()
+        keys += [self.countKey(res) for res in self.timeResolutions]
+        keys += [self.retentionKey(res) for res in self.timeResolutions]
+        starts = [self.slotStart(timestamp, res) for res in self.timeResolutions]
+        now = time.time()
+        closed = [1 if start + res <= now else 0 for start, res in zip(starts, self.timeResolutions)]
+
+        _addMember(keys=keys, args=[int(objectId)] + starts + closed, conn=self._getConnection())
 
+    def members(self, timestamp, resolution=None, chunkSize=8192):
+        """
+        Iterate over the members of a time slot, without loading the whole bitmap at once.
+        If the counter has an IdMapper, the original ids are returned. Archived slots can't be streamed
+        @param timestamp any time in the slot
+        @param resolution the slot's resolution, defaults to the first resolution given to the counter
+        @param chunkSize how many bytes of the bitmap to read at a time
+        """
+        self.__checkNotArchived(timestamp, resolution)
+        return _iterMembers(self._getConnection(), self.getKey(timestamp, resolution), self.idMapper, chunkSize)
+
+    @timed('bitmap.isset')
     def isSet(self, objectId, timestamp, timeResolution=None):
         """
         Tell us whether a specific objectId is set in the counter for a specific resolution
@@ -117,24 +236,110 @@ class BitmapCounter(Rediston):
         """
         timeResolution = timeResolution or self.timeResolutions[0]
         key = self.getKey(timestamp, timeResolution)
-        return self._getConnection().getbit(key, objectId)
+        ret = self._getConnection().getbit(key, objectId)
+        if ret or not self.__archived([timestamp], timeResolution):
+            return ret
+
+        bitmap = self.archive.bitmap(self.metric, timeResolution, self.slotStart(timestamp, timeResolution))
+        idx = int(objectId) >> 3
+        if idx >= len(bitmap):
+            return 0
+        byte = bitmap[idx]
+        return (ord(byte) if isinstance(byte, str) else int(byte)) >> (7 - (int(objectId) & 7)) & 1
 
 
+    @timed('bitmap.count')
     def getCount(self, timestamps, timeResolution=None):
         """
-        Count the cardinality of time slots
+        Count the cardinality of time slots.
+        Counts are read from a cache hash: closed slots are counted once, and open slots keep a running count that add()
+        increments, so usually this is a single HMGET. The running count misses members set without add()
         @param timestamps a list of timestamps to test
         @param timeResolution the time slot to aggregate, defaults to the first resolution given to the counter
         @return a list of [(timestamp, count), ...]
         """
         timeResolution = timeResolution or self.timeResolutions[0]
+        if not timestamps:
+            return []
+
+        now = time.time()
+        starts = [self.slotStart(ts, timeResolution) for ts in timestamps]
+        fields = [str(start) if start + timeResolution <= now else '%s:open' % start for start in starts]
+
+        cacheKey = self.countKey(timeResolution)
         pipe = self._getPipeline()
+        pipe.hmget(cacheKey, fields)
+        pipe.expire(cacheKey, self.COUNT_CACHE_TTL)
+        counts = pipe.execute()[0]
 
-        [pipe.bitcount(self.getKey(timestamp, timeResolution)) for timestamp in timestamps]
-        return zip(timestamps, pipe.execute())
+        missing = [idx for idx, count in enumerate(counts) if count is None]
+        if not missing:
+            instrumentation.count('bitmap.count.hit', len(counts))
+            return zip(timestamps, map(int, counts))
+
+        instrumentation.count('bitmap.count.miss', len(missing))
+        archived = set(self.__archived(timestamps, timeResolution))
+        pipe = self._getPipeline()
+        for idx in missing:
+            keys = (self.getKey(timestamps[idx], timeResolution), cacheKey)
+            if fields[idx].endswith(':open'):
+                _seedCount(keys=keys, args=(fields[idx],), conn=pipe)
+            elif idx in archived:
+                #merged with the archive below
+                pipe.bitcount(keys[0])
+            else:
+                _storeCount(keys=keys, args=(fields[idx],), conn=pipe)
+        #the hash may have just been created
+        pipe.expire(cacheKey, self.COUNT_CACHE_TTL)
+        for idx, count in zip(missing, defaultRegistry.execute(pipe, self._getConnection())):
+            counts[idx] = count
 
+        archived = [idx for idx in missing if idx in archived]
+        if archived:
+            pipe = self._getPipeline()
+            for idx in archived:
+                bits = counts[idx]
+                if bits:
+                    #members added after the slot was archived
+                    counts[idx] = bitopCount('OR', self.__bitmaps([timestamps[idx]], timeResolution))
+                else:
+                    counts[idx] = self.archive.count(self.metric, timeResolution, starts[idx])
+                _storeCount(keys=(self.getKey(timestamps[idx], timeResolution), cacheKey),
+                            args=(fields[idx], counts[idx], bits), conn=pipe)
+            pipe.expire(cacheKey, self.COUNT_CACHE_TTL)
+            defaultRegistry.execute(pipe, self._getConnection())
 
+        return zip(timestamps, map(int, counts))
+
+    def __archived(self, timestamps, timeResolution):
+        """
+        @return the indexes of the timestamps whose slots are archived
+        """
+        if self.archive is None:
+            return []
+        return [idx for idx, ts in enumerate(timestamps)
+                if self.archive.has(self.metric, timeResolution, self.slotStart(ts, timeResolution))]
 
+    def __bitmaps(self, timestamps, timeResolution):
+        """
+        Get the bitmaps of time slots, from redis or from the archive
+        @return a list of strings, or numpy arrays for archived slots
+        """
+        pipe = self._getPipeline()
+        [pipe.get(self.getKey(timestamp, timeResolution)) for timestamp in timestamps]
+        bitmaps = [b or '' for b in pipe.execute()]
+
+        for idx in self.__archived(timestamps, timeResolution):
+            archived = self.archive.bitmap(self.metric, timeResolution, self.slotStart(timestamps[idx], timeResolution))
+            if bitmaps[idx]:
+                archived = _orBitmaps(archived if isinstance(archived, str) else archived.tostring(), bitmaps[idx])
+            bitmaps[idx] = archived
+
+        return bitmaps
+
+
+
+    @timed('bitmap.aggregate')
     def aggregateCounts(self, timestamps, op=OP_TOTAL, timeResolution=None, expire=True):
         """
         Aggregate a few time slots, either summing the unique total, average or memebers in all slots
@@ -153,6 +358,10 @@ class BitmapCounter(Rediston):
         else:
             bitop = 'OR'
 
+        if self.__archived(timestamps, timeResolution):
+            ret = bitopCount(bitop, self.__bitmaps(timestamps, timeResolution))
+            return float(ret) / len(timestamps) if op == BitmapCounter.OP_AVG else ret
+
         dest = 'aggregate:%s:%s' % (self.metric, hash(timestamps))
         pipe = self._getPipeline()
         pipe.bitop(bitop, dest, *(self.getKey(timestamp, timeResolution) for timestamp in timestamps))
@@ -166,6 +375,7 @@ class BitmapCounter(Rediston):
         else:
             return ret
 
+    @timed('bitmap.cohort')
     def cohortAnalysis(self, timestamps, timeResolution, filterBitmapKey=None):
         """
         Given a list of timestamps, generates a list of retention measures of the first timestamp, for each later timestamp
@@ -178,6 +388,12 @@ class BitmapCounter(Rediston):
         #put the first timestamp as the first record in what we return
         ret = []
         conn = self._getConnection()
+
+        if self.__archived(timestamps, timeResolution):
+            bitmaps = self.__bitmaps(timestamps, timeResolution)
+            filters = [conn.get(filterBitmapKey) or ''] if filterBitmapKey else []
+            return [(ts, bitopCount('AND', [bitmaps[0], bitmap] + filters)) for ts, bitmap in zip(timestamps, bitmaps)]
+
         #get the count for each timestamp
         for idx, ts in enumerate(timestamps):
             dest = 'cohort:%s:%s:%s' % (self.metric, ts, idx)
@@ -197,6 +413,7 @@ class BitmapCounter(Rediston):
         return ret
 
 
+    @timed('bitmap.funnel')
     def funnelAnalysis(self, timestamps, timeResolution, filterBitmapKey=None):
         """
         Given a list of timestamps, return a funnel analysis - i.e. for each timestamp, an interesection of it and all the previous points
@@ -207,6 +424,15 @@ class BitmapCounter(Rediston):
         """
         conn = self._getConnection()
 
+        if self.__archived(timestamps, timeResolution):
+            bitmaps = self.__bitmaps(timestamps, timeResolution)
+            funnel = [conn.get(filterBitmapKey) or ''] if filterBitmapKey else [bitmaps[0]]
+            ret = []
+            for ts, bitmap in zip(timestamps, bitmaps):
+                funnel.append(bitmap)
+                ret.append((ts, bitopCount('AND', funnel)))
+            return ret
+
         prev = None
         ret = []
         #get the count for each timestamp
@@ -225,6 +451,473 @@ class BitmapCounter(Rediston):
         return ret
 
 
+    #retention matrix cells of closed time slots never change, so they are cached in a hash per metric and resolution
+    RETENTION_CACHE_TTL = 30 * 86400
+
+    @timed('bitmap.retention')
+    def retentionMatrix(self, timestamps, timeResolution=None, newUsers=False, rolling=False, local=False, cache=True):
+        """
+        Compute a full retention triangle: for each time slot's cohort, how many of its members are in each later slot.
+        The whole triangle is computed in a single pipeline, and intermediate results are computed once and reused.
+        Cells of closed time slots are cached, so a report over past periods is only computed once
+        @param timestamps a list of timestamps to sample, one per slot
+        @param timeResolution the time slot to sample, defaults to the first resolution given to the counter
+        @param newUsers if True, a slot's cohort is only the members that were not in any earlier slot of timestamps
+        @param rolling if True, count the cohort members that were in every slot since the cohort's slot, instead of
+        just the later slot
+        @param local if True, get the bitmaps and compute the matrix in the client with numpy instead of in redis.
+        this is always done if any of the slots is archived
+        @param cache if False, ignore the cache and do not write to it
+        @return a list of rows, one per cohort: [(cohortTimestamp, [(timestamp, count), ...]), ...]
+        """
+        timeResolution = timeResolution or self.timeResolutions[0]
+        timestamps = sorted(timestamps)
+        n = len(timestamps)
+        if not n:
+            return []
+
+        keys = [self.getKey(ts, timeResolution) for ts in timestamps]
+        starts = [self.slotStart(ts, timeResolution) for ts in timestamps]
+
+        #new user cohorts depend on where the window starts
+        mode = '%s%s' % ('new:%s' % starts[0] if newUsers else 'active', ':rolling' if rolling else '')
+        fields = [['%s:%s:%s' % (mode, starts[i], starts[j]) for j in xrange(i, n)] for i in xrange(n)]
+
+        cacheKey = self.retentionKey(timeResolution)
+        conn = self._getConnection()
+        if cache:
+            cached = iter(conn.hmget(cacheKey, [f for row in fields for f in row]))
+            counts = [[next(cached) for _ in row] for row in fields]
+        else:
+            counts = [[None] * len(row) for row in fields]
+
+        #the cells to compute, by row
+        missing = {}
+        for i in xrange(n):
+            cells = [j for j in xrange(i, n) if counts[i][j - i] is None]
+            if cells:
+                missing[i] = cells
+
+        if missing:
+            #archived slots are not in redis, so they can only be computed locally
+            if local or self.__archived(timestamps, timeResolution):
+                computed = self.__localRetention(timestamps, timeResolution, missing, newUsers, rolling)
+            else:
+                computed = self.__redisRetention(keys, missing, newUsers, rolling)
+            for (i, j), count in computed.iteritems():
+                counts[i][j - i] = count
+
+            if cache:
+                now = time.time()
+                closed = {}
+                for (i, j), count in computed.iteritems():
+                    if starts[j] + timeResolution <= now:
+                        closed[fields[i][j - i]] = count
+                if closed:
+                    pipe = self._getPipeline()
+                    pipe.hmset(cacheKey, closed)
+                    pipe.expire(cacheKey, self.RETENTION_CACHE_TTL)
+                    pipe.execute()
+
+        return [(timestamps[i], zip(timestamps[i:], map(int, counts[i]))) for i in xrange(n)]
+
+    def __redisRetention(self, keys, missing, newUsers, rolling):
+        """
+        Compute cells of the retention matrix with BITOPs, in one pipeline
+        @param missing a dict of row => the columns to compute in it
+        @return a dict of (row, column) => count
+        """
+        prefix = 'retention:tmp:%s' % generateRandomId()
+        temps = []
+        pipe = self._getPipeline()
+
+        def bitop(op, name, *sources):
+            dest = '%s:%s' % (prefix, name)
+            pipe.bitop(op, dest, *sources)
+            pipe.expire(dest, 60)
+            temps.append(dest)
+            return dest
+
+        cohorts = list(keys)
+        if newUsers:
+            #the union of the previous slots is built once, and each new cohort is subtracted from it
+            lastRow = max(missing)
+            seen = keys[0]
+            for i in xrange(1, lastRow + 1):
+                cohorts[i] = bitop('XOR', 'new:%d' % i, keys[i], bitop('AND', 'old:%d' % i, keys[i], seen))
+                if i < lastRow:
+                    seen = bitop('OR', 'seen:%d' % i, seen, keys[i])
+
+        countIdx = {}
+        for i, cells in missing.iteritems():
+            if rolling:
+                #rolling retention continues from the previous cell, so the row is computed up to its last missing cell
+                retained = cohorts[i]
+                for j in xrange(i, cells[-1] + 1):
+                    if j > i:
+                        retained = bitop('AND', '%d:%d' % (i, j), retained, keys[j])
+                    if j in cells:
+                        countIdx[(i, j)] = len(pipe.command_stack)
+                        pipe.bitcount(retained)
+            else:
+                for j in cells:
+                    retained = cohorts[i] if j == i else bitop('AND', '%d:%d' % (i, j), cohorts[i], keys[j])
+                    countIdx[(i, j)] = len(pipe.command_stack)
+                    pipe.bitcount(retained)
+
+        if temps:
+            pipe.delete(*temps)
+        res = pipe.execute()
+
+        return {cell: res[idx] for cell, idx in countIdx.iteritems()}
+
+    def __localRetention(self, timestamps, timeResolution, missing, newUsers, rolling):
+        """
+        Compute cells of the retention matrix in the client with numpy, from the raw bitmaps
+        """
+        if numpy is None:
+            raise RuntimeError("numpy is needed for local retention computation")
+
+        raw = self.__bitmaps(timestamps, timeResolution)
+
+        bitmaps = numpy.zeros((len(raw), max(len(r) for r in raw)), dtype=numpy.uint8)
+        for i, r in enumerate(raw):
+            bitmaps[i, :len(r)] = numpy.frombuffer(r, dtype=numpy.uint8) if isinstance(r, str) else r
+
+        cohorts = bitmaps
+        if newUsers:
+            seen = numpy.bitwise_or.accumulate(bitmaps, axis=0)
+            cohorts = bitmaps.copy()
+            cohorts[1:] &= ~seen[:-1]
+
+        ret = {}
+        for i, cells in missing.iteritems():
+            later = bitmaps[i + 1:]
+            if rolling:
+                retained = numpy.bitwise_and.accumulate(numpy.vstack((cohorts[i:i + 1], later)), axis=0)
+            else:
+                retained = numpy.vstack((cohorts[i:i + 1], cohorts[i] & later))
+            counts = _POPCOUNT[retained].sum(axis=1)
+            for j in cells:
+                ret[(i, j)] = int(counts[j - i])
+
+        return ret
+
+
+if numpy is not None:
+    #the number of set bits in each byte value
+    _POPCOUNT = numpy.array([bin(i).count('1') for i in xrange(256)], dtype=numpy.int64)
+
+
+class BitmapExpression(Rediston):
+    """
+    A set algebra expression over bitmaps, built with the &, |, ^, ~ and - (AND NOT) operators.
+    It is compiled to a minimal sequence of BITOPs into temporary keys. Identical sub-expressions are computed once,
+    and operands of the same operation are merged into a single BITOP. Everything runs in a single pipeline.
+    NOT is only defined as a subtraction: x & ~y, or x - y. The complement of a bitmap on its own is unbounded.
+    The expression runs on the server of the counters its slots come from, which must all be on the same server.
+    Example:
+    >>> segment = (dau.slot(t) & mobile.slot(t)) - churned.slot(t, BitmapCounter.RES_WEEK)
+    >>> print segment.count()
+    """
+
+    __slots__ = ('signature',)
+
+    #temporary keys are deleted by the pipeline that creates them, this is just a safety net
+    TEMP_TTL = 60
+
+    def __and__(self, other):
+
+        return _operation('AND', (self, other))
+
+    def __or__(self, other):
+
+        return _operation('OR', (self, other))
+
+    def __xor__(self, other):
+
+        return _operation('XOR', (self, other))
+
+    def __invert__(self):
+
+        return self.child if isinstance(self, _Not) else _Not(self)
+
+    def __sub__(self, other):
+
+        return self & ~other
+
+    def __repr__(self):
+
+        return self.signature
+
+    def compile(self, prefix='segment:tmp'):
+        """
+        Compile the expression
+        @param prefix the prefix of the temporary keys
+        @return a tuple of ([(bitop, destKey, sourceKeys), ...], the key holding the result)
+        """
+        compiler = _ExpressionCompiler(prefix)
+        return compiler.ops, compiler.key(self)
+
+    def _leaves(self):
+
+        if isinstance(self, Bitmap):
+            return [self]
+        if isinstance(self, _Not):
+            return self.child._leaves()
+        return [leaf for c in self.children for leaf in c._leaves()]
+
+    def _connection(self):
+        """
+        Get the connection of the server the operands are on. bitmaps given as plain keys are assumed to be there too,
+        and if there are only plain keys, the expression's own connection is used
+        """
+        conn = server = None
+        for leaf in self._leaves():
+            if leaf.source is None:
+                continue
+            leafConn = leaf.source._getConnection()
+            kwargs = leafConn.connection_pool.connection_kwargs
+            leafServer = (kwargs.get('host'), kwargs.get('port'), kwargs.get('db'), kwargs.get('path'))
+            if conn is None:
+                conn, server = leafConn, leafServer
+            elif leafServer != server:
+                raise ValueError("The operands of %s are on different servers: %s and %s" % (self, server, leafServer))
+
+        return conn if conn is not None else self._getConnection()
+
+    def __execute(self, dest=None, expire=None):
+
+        ops, resultKey = self.compile('segment:%s' % generateRandomId())
+        temps = [d for _, d, _ in ops]
+
+        #write the last operation straight to the destination instead of to a temporary key
+        if dest:
+            if ops and ops[-1][1] == resultKey:
+                ops[-1] = (ops[-1][0], dest, ops[-1][2])
+                temps.pop()
+            else:
+                ops.append(('OR', dest, [resultKey]))
+            resultKey = dest
+
+        pipe = self._connection().pipeline(transaction=False)
+        for op, d, keys in ops:
+            pipe.bitop(op, d, *keys)
+            if d != dest:
+                pipe.expire(d, self.TEMP_TTL)
+        countIdx = len(pipe.command_stack)
+        pipe.bitcount(resultKey)
+        if dest and expire:
+            pipe.expire(dest, expire)
+        if temps:
+            pipe.delete(*temps)
+
+        return pipe.execute()[countIdx]
+
+    @timed('bitmap.expression.count')
+    def count(self):
+        """
+        Count the members of the expression's result
+        """
+        return self.__execute()
+
+    @timed('bitmap.expression.store')
+    def store(self, dest, expire=None):
+        """
+        Save the expression's result to a key, e.g. to use it as a filter bitmap or to list its members
+        @param dest the destination key
+        @param expire optional ttl of the destination key, in seconds
+        @return the number of members in the result
+        """
+        return self.__execute(dest, expire)
+
+    #how long the snapshot of an expression's result is kept while its members are streamed
+    MEMBERS_TTL = 3600
+
+    def members(self, idMapper=None, chunkSize=8192):
+        """
+        Iterate over the members of the expression's result. The result is computed once into a temporary key,
+        which is streamed in chunks and deleted when the iteration ends
+        @param idMapper if given, map the sequential ids back to the original ids with it
+        @param chunkSize how many bytes of the bitmap to read at a time
+        """
+        conn = self._connection()
+        if isinstance(self, Bitmap):
+            for id in _iterMembers(conn, self.key, idMapper, chunkSize):
+                yield id
+            return
+
+        dest = 'segment:%s' % generateRandomId()
+        self.store(dest, self.MEMBERS_TTL)
+        try:
+            for id in _iterMembers(conn, dest, idMapper, chunkSize):
+                yield id
+        finally:
+            conn.delete(dest)
+
+
+class Bitmap(BitmapExpression):
+    """
+    A bitmap key as an expression operand
+    """
+
+    __slots__ = ('key', 'source')
+
+    def __init__(self, key, source=None):
+        """
+        @param key the bitmap's key
+        @param source the Rediston object the key is read with, e.g. its BitmapCounter
+        """
+        self.key = key
+        self.source = source
+        self.signature = key
+
+
+class _Not(BitmapExpression):
+
+    __slots__ = ('child',)
+
+    def __init__(self, child):
+
+        self.child = child
+        self.signature = '~%s' % child.signature
+
+
+class _Operation(BitmapExpression):
+
+    __slots__ = ('op', 'children')
+
+    def __init__(self, op, children):
+
+        self.op = op
+        self.children = children
+        self.signature = '(%s)' % (' %s ' % op).join(c.signature for c in children)
+
+
+def _operation(op, operands):
+    """
+    Create a normalized operation: nested operations of the same kind are flattened, operands are sorted, so the same
+    sub-expression always has the same signature, and redundant operands are removed
+    """
+    children = {}
+    for operand in operands:
+        for child in (operand.children if isinstance(operand, _Operation) and operand.op == op else (operand,)):
+            if op == 'XOR' and child.signature in children:
+                #x ^ x cancels out
+                del children[child.signature]
+            else:
+                children[child.signature] = child
+
+    children = [children[k] for k in sorted(children)]
+    if not children:
+        raise ValueError("Empty bitmap expression")
+    if len(children) == 1:
+        return children[0]
+    return _Operation(op, tuple(children))
+
+
+class _ExpressionCompiler(object):
+    """
+    Compiles expressions to BITOPs, emitting each distinct sub-expression once
+    """
+
+    def __init__(self, prefix):
+
+        self.prefix = prefix
+        self.ops = []
+        self.keys = {}
+
+    def emit(self, op, sourceKeys):
+
+        #the sources may emit operations of their own, so they are computed before naming the destination
+        sourceKeys = list(sourceKeys)
+        dest = '%s:%d' % (self.prefix, len(self.ops))
+        self.ops.append((op, dest, sourceKeys))
+        return dest
+
+    def key(self, node):
+        """
+        @return the key holding the result of a node, emitting the operations needed to compute it
+        """
+        if isinstance(node, Bitmap):
+            return node.key
+
+        key = self.keys.get(node.signature)
+        if key is not None:
+            return key
+
+        if isinstance(node, _Not):
+            raise ValueError("NOT can only be subtracted from something: %s" % node)
+
+        positive = [c for c in node.children if not isinstance(c, _Not)]
+        negative = [c.child for c in node.children if isinstance(c, _Not)]
+
+        if negative and node.op != 'AND':
+            raise ValueError("NOT is only supported in an AND: %s" % node)
+        if not positive:
+            raise ValueError("An AND of NOTs is unbounded: %s" % node)
+
+        if not negative:
+            key = self.emit(node.op, (self.key(c) for c in positive))
+        else:
+            #BITOP NOT only covers the length of its operand, so x - y is computed as x ^ (x & y)
+            posKey = self.key(_operation('AND', positive))
+            negKey = self.key(_operation('OR', negative))
+            key = self.emit('XOR', (posKey, self.emit('AND', (posKey, negKey))))
+
+        self.keys[node.signature] = key
+        return key
+
+
+#the positions of the set bits in each byte value, most significant bit first like redis bit offsets
+_BIT_POSITIONS = [tuple(i for i in xrange(8) if b & (0x80 >> i)) for b in xrange(256)]
+
+
+def _decodeBits(chunk, offset):
+    """
+    Get the offsets of the set bits in a chunk of a bitmap
+    @param chunk the chunk's bytes
+    @param offset the offset of the chunk in the bitmap, in bytes
+    """
+    if numpy is not None:
+        bits = numpy.unpackbits(numpy.frombuffer(chunk, dtype=numpy.uint8))
+        return (numpy.flatnonzero(bits) + offset * 8).tolist()
+
+    ret = []
+    for pos, byte in enumerate(bytearray(chunk)):
+        if byte:
+            base = (offset + pos) * 8
+            ret.extend([base + b for b in _BIT_POSITIONS[byte]])
+    return ret
+
+
+def _iterMembers(conn, key, idMapper=None, chunkSize=8192):
+    """
+    Stream the offsets of the set bits of a bitmap with GETRANGE, optionally mapping them back to original ids
+    """
+    offset = 0
+    unmapped = 0
+    while True:
+        chunk = conn.getrange(key, offset, offset + chunkSize - 1)
+        if not chunk:
+            break
+
+        ids = _decodeBits(chunk, offset)
+        if ids and idMapper:
+            originalIds = idMapper.getOriginalIds(ids)
+            unmapped += originalIds.count(None)
+            ids = [id for id in originalIds if id is not None]
+
+        for id in ids:
+            yield id
+
+        if len(chunk) < chunkSize:
+            break
+        offset += chunkSize
+
+    if unmapped:
+        logging.warn("%d members of %s have no reverse id mapping, see IdMapper.rebuildReverseIndex()", unmapped, key)
+
 
 class IdMapper(Rediston):
 
@@ -239,10 +932,18 @@ class IdMapper(Rediston):
         self.prefix = prefix
         self.idgen = IncrementalIdGenerator(namespace=self._redisKey())
 
+    #how many sequential ids each hash of the reverse index holds. small hashes are kept in redis' compact encoding
+    REVERSE_BUCKET_SIZE = 512
+
     def _redisKey(self):
 
         return 'idmap:%s' % self.prefix
 
+    def _reverseKey(self, sequentialId):
+
+        return 'idmap:%s:rev:%d' % (self.prefix, int(sequentialId) // self.REVERSE_BUCKET_SIZE)
+
+    @timed('idmapper.get')
     def getSequentialId(self, objectId):
         """
         Convert a non sequential id to sequential id, by either creating a new mapping or retrieving an old one
@@ -251,18 +952,100 @@ class IdMapper(Rediston):
         conn = self._getConnection()
         rc = conn.hget(self._redisKey(), objectId)
         if rc:
-            logging.info("Found id mapping for %s:%s: %s", self.prefix, objectId, rc)
+            instrumentation.count('idmapper.hit')
+            if util.DEBUG:
+                logging.debug("Found id mapping for %s:%s: %s", self.prefix, objectId, rc)
             return rc
         else:
+            instrumentation.count('idmapper.miss')
             id = self.idgen.getId()
             rc = conn.hsetnx(self._redisKey(), objectId, id)
             if rc: #the write was successful
-                logging.info("Created new sequential id for %s:%s: %s", self.prefix, objectId, rc)
+                conn.hset(self._reverseKey(id), id % self.REVERSE_BUCKET_SIZE, objectId)
+                if util.DEBUG:
+                    logging.debug("Created new sequential id for %s:%s: %s", self.prefix, objectId, rc)
                 return id
             else: #possible race condition
-                logging.info("Got new sequential id for %s:%s: %s", self.prefix, objectId, rc)
+                if util.DEBUG:
+                    logging.debug("Got new sequential id for %s:%s: %s", self.prefix, objectId, rc)
                 return conn.hget(self._redisKey(), objectId)
 
+    @timed('idmapper.getmany')
+    def getSequentialIds(self, objectIds):
+        """
+        Bulk version of getSequentialId: get the existing mappings in one round-trip, and create the missing ones
+        in another
+        @return a list of sequential ids aligned with objectIds
+        """
+        if not objectIds:
+            return []
+
+        key = self._redisKey()
+        conn = self._getConnection()
+        unique = list(set(objectIds))
+        mapping = dict(zip(unique, conn.hmget(key, unique)))
+
+        missing = [objectId for objectId in unique if mapping[objectId] is None]
+        if missing:
+            instrumentation.count('idmapper.miss', len(missing))
+            for objectId in missing:
+                mapping[objectId] = self.idgen.getId()
+
+            pipe = self._getPipeline()
+            [pipe.hsetnx(key, objectId, mapping[objectId]) for objectId in missing]
+            created = pipe.execute()
+
+            for objectId, rc in zip(missing, created):
+                id = mapping[objectId]
+                if rc:
+                    pipe.hset(self._reverseKey(id), id % self.REVERSE_BUCKET_SIZE, objectId)
+                else:
+                    #someone else mapped it first
+                    pipe.hget(key, objectId)
+            res = pipe.execute()
+
+            for objectId, rc, r in zip(missing, created, res):
+                if not rc:
+                    mapping[objectId] = r
+
+        return [int(mapping[objectId]) for objectId in objectIds]
+
+    @timed('idmapper.reverse')
+    def getOriginalIds(self, sequentialIds):
+        """
+        Map sequential ids back to the original ids, in a single round-trip
+        @return a list of original ids aligned with sequentialIds, with None for unknown ids
+        """
+        buckets = {}
+        for idx, id in enumerate(sequentialIds):
+            buckets.setdefault(self._reverseKey(id), []).append(idx)
+
+        pipe = self._getPipeline()
+        for key, idxs in buckets.iteritems():
+            pipe.hmget(key, [int(sequentialIds[i]) % self.REVERSE_BUCKET_SIZE for i in idxs])
+
+        ret = [None] * len(sequentialIds)
+        for idxs, values in zip(buckets.itervalues(), pipe.execute()):
+            for i, value in zip(idxs, values):
+                ret[i] = value
+        return ret
+
+    def rebuildReverseIndex(self, batchSize=1000):
+        """
+        Build the reverse index of mappings created before it existed, scanning the mapping in pipelined batches
+        @return the number of mappings indexed
+        """
+        conn = self._getConnection()
+        pipe = self._getPipeline()
+        num = 0
+        for objectId, id in conn.hscan_iter(self._redisKey(), count=batchSize):
+            pipe.hset(self._reverseKey(id), int(id) % self.REVERSE_BUCKET_SIZE, objectId)
+            num += 1
+            if num % batchSize == 0:
+                pipe.execute()
+        pipe.execute()
+        return num
+
 
 
 
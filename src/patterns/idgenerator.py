@@ -27,29 +27,53 @@ from __future__ import absolute_import
 
 __author__ = 'dvirsky'
 
-from ..util import Rediston, InstanceCache
-from threading import RLock
-from collections import deque
+from ..util import Rediston, InstanceCache, generateRandomId
+from .. import instrumentation
+from ..instrumentation import timed
+from .lua import LuaCall
+from threading import Lock, Thread
+from itertools import count
+import Queue
 import logging
+import random
+import time
 
 
 class IncrementalIdGenerator(Rediston):
     """
     This class generates guaranteed unique incremental object ids, using redis, that can be pulled from many machines.
     To optimize performance, it doesn't need to request a new id from redis each time.
-    Instead it reserves N ids in the clients, and hands them out until they run out.
+    Instead it reserves a block of ids in the clients, and hands them out until they run out.
+    When the block runs low, the next one is reserved in a background thread, so under steady load getting an id
+    never waits for redis. The block size adapts to the rate ids are consumed at.
     This is thread safe and can be used from multiple processes or machines
     """
-    def __init__(self, namespace, maxReserveBuffer = 100):
+
+    #the block size is adapted so that a block lasts about this long
+    TARGET_BLOCK_SECONDS = 1.0
+
+    def __init__(self, namespace, maxReserveBuffer = 100, maxBlockSize = 100000, prefetch = True, adaptive = True):
         """
         @param namespace this is the namespace of the ids to be generated. each namespace is a single id generator
-        @param maxReserveBuffer how many ids we want to reserve from redis. If you can't accept any "holes" in object
-        ids in case of a process crash, set this to 1
+        @param maxReserveBuffer how many ids we want to reserve from redis at least. If you can't accept any "holes" in object
+        ids in case of a process crash, set this to 1, and set prefetch and adaptive to False
+        @param maxBlockSize the upper bound of the adaptive block size
+        @param prefetch whether to reserve the next block in the background when the current one runs low
+        @param adaptive whether to grow or shrink the block size according to the consumption rate
         """
         self.namespace = namespace
         self.maxReserveBuffer = maxReserveBuffer
-        self.reservedIdsCache = deque()
-        self.__lock = RLock()
+        self.maxBlockSize = max(maxBlockSize, maxReserveBuffer)
+        self.prefetch = prefetch
+        self.adaptive = adaptive
+
+        self.blockSize = maxReserveBuffer
+        #the current block is an (id counter, end, low water id) tuple, replaced as a whole when it runs out
+        self.__block = (count(0), 0, None)
+        self.__blockStart = time.time()
+        self.__prefetched = Queue.Queue(maxsize=1)
+        self.__prefetching = False
+        self.__lock = Lock()
 
     @InstanceCache
     def __redisKey(self):
@@ -58,30 +82,231 @@ class IncrementalIdGenerator(Rediston):
         """
         return ':%s:idgen' % self.namespace
 
-    def __reserveIds(self):
+    @timed('idgen.reserve')
+    def __reserveIds(self, size):
+        """
+        Call redis and reserve a block of ids
+        @return a (first, end) range of the reserved ids
+        """
+        conn = self._getConnection('master')
+        res = conn.incr(self.__redisKey(), size)
+        instrumentation.count('idgen.reserved', size)
+        return res - size + 1, res + 1
+
+    def __prefetchIds(self, size):
+        """
+        Reserve the next block in the background
+        """
+        try:
+            self.__prefetched.put(self.__reserveIds(size))
+        except Exception, e:
+            logging.warn("Could not prefetch ids for %s: %s", self.namespace, e)
+            self.__prefetched.put(None)
+
+    def __adaptBlockSize(self):
         """
-        Call redis and reserve more ids
+        Compute the size of the next block from the rate the last one was consumed at
         """
+        now = time.time()
+        elapsed = max(now - self.__blockStart, 0.001)
+        self.__blockStart = now
+
+        if self.adaptive:
+            #at most double or halve at a time, so a short burst doesn't reserve a huge block
+            wanted = (self.blockSize / elapsed) * self.TARGET_BLOCK_SECONDS
+            wanted = min(self.blockSize * 2, max(self.blockSize // 2, wanted))
+            self.blockSize = int(min(self.maxBlockSize, max(self.maxReserveBuffer, wanted)))
+
+        return self.blockSize
+
+    def __startPrefetch(self):
+
         with self.__lock:
-            conn = self._getConnection('master')
-            res = conn.incr(self.__redisKey(), self.maxReserveBuffer)
-            self.reservedIdsCache = deque((res - (self.maxReserveBuffer - i - 1) for i in xrange(self.maxReserveBuffer)))
+            if self.__prefetching:
+                return
+            self.__prefetching = True
+            size = self.__adaptBlockSize()
 
-            #logging.info("Reserved new ids: %s", list(self.reservedIdsCache))
+        t = Thread(target=self.__prefetchIds, args=(size,))
+        t.daemon = True
+        t.start()
 
-    def getId(self):
+    @timed('idgen.refill')
+    def __nextBlock(self, exhausted):
         """
-        Pop one id, request more from redis if there aren't any left in the cache
+        Replace an exhausted block with the prefetched one, or reserve a new one if there isn't any
         """
         with self.__lock:
+            #another thread already replaced it
+            if self.__block[0] is not exhausted:
+                return
+
+            block = None
+            if self.__prefetching:
+                block = self.__prefetched.get()
+                self.__prefetching = False
+
+            if block is None:
+                #the callers are blocked on a round-trip - prefetching did not keep up
+                instrumentation.count('idgen.stall')
+                block = self.__reserveIds(self.__adaptBlockSize())
+
+            first, end = block
+            lowWaterId = end - max(1, (end - first) // 4) if self.prefetch else None
+            self.__block = (count(first), end, lowWaterId)
+
+    def getId(self):
+        """
+        Get one id, request more from redis if there aren't any left in the cache
+        """
+        while True:
+            counter, end, lowWaterId = self.__block
+            #next() on a count object is atomic, so the fast path needs no lock
+            id = next(counter)
+            if id < end:
+                if id == lowWaterId:
+                    self.__startPrefetch()
+                return id
+
+            self.__nextBlock(counter)
+
+
+#renew a node id lease only if it is still ours
+_renewLease = LuaCall("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+
+class TimeBasedIdGenerator(Rediston):
+    """
+    This class generates unique, roughly time sortable 53 bit ids without coordination between machines.
+    Each id is made of a 41 bit millisecond timestamp, a node id and a sequence number inside the millisecond.
+    53 bits is what a double holds exactly, so the ids are exact sorted set scores in the ids:<class> index.
+    Redis is only used to lease a unique node id when the first id is generated. The lease has a TTL and is kept alive
+    by a heartbeat thread, so node ids of dead processes are eventually reused. If the lease is lost, e.g. in an
+    outage longer than the TTL, a new node id is leased on the next call.
+    Use it in an object class by setting _idGenerator = TimeBasedIdGenerator('myclass')
+    """
+
+    #2015-01-01 00:00:00 GMT, in milliseconds
+    EPOCH = 1420070400000
+
+    #the largest integer a double holds exactly, and the bits the timestamp needs to last until 2084
+    ID_BITS = 53
+    TIMESTAMP_BITS = 41
+
+    def __init__(self, namespace, nodeBits = 6, sequenceBits = 6, leaseTTL = 60):
+        """
+        @param namespace the namespace of the node ids. generators sharing a namespace get different node ids
+        @param nodeBits how many bits of the id are dedicated to the node id, i.e. up to 2**nodeBits concurrent nodes
+        @param sequenceBits how many bits are dedicated to the sequence, i.e. up to 2**sequenceBits ids per millisecond per node
+        @param leaseTTL the TTL of the node id lease in seconds. the heartbeat renews it every third of that
+        """
+        if nodeBits + sequenceBits > self.ID_BITS - self.TIMESTAMP_BITS:
+            raise ValueError("nodeBits + sequenceBits must be at most %d for ids to fit in a sorted set score" %
+                             (self.ID_BITS - self.TIMESTAMP_BITS))
+
+        self.namespace = namespace
+        self.nodeBits = nodeBits
+        self.sequenceBits = sequenceBits
+        self.maxNodes = 1 << nodeBits
+        self.maxSequence = (1 << sequenceBits) - 1
+        self.leaseTTL = leaseTTL
+
+        self.nodeId = None
+        self.leaseLost = False
+        self.__leaseExpires = 0
+        self.__token = generateRandomId()
+        self.__lastTimestamp = -1
+        self.__sequence = 0
+        self.__lock = Lock()
+
+    def __nodeKey(self, nodeId):
+        """
+        The redis key of a node id lease
+        """
+        return ':%s:idgen:node:%d' % (self.namespace, nodeId)
+
+    def __leaseNodeId(self):
+        """
+        Find a free node id and lease it. we start at a random node id to avoid contention between starting processes
+        """
+        conn = self._getConnection('master')
+        start = random.randint(0, self.maxNodes - 1)
+        for i in xrange(self.maxNodes):
+            nodeId = (start + i) % self.maxNodes
+            expires = time.time() + self.leaseTTL
+            if conn.set(self.__nodeKey(nodeId), self.__token, ex=self.leaseTTL, nx=True):
+                self.__leaseExpires = expires
+                logging.info("Leased node id %d for %s", nodeId, self.namespace)
+                return nodeId
+
+        raise RuntimeError("Could not lease a node id for %s, all %d are taken" % (self.namespace, self.maxNodes))
+
+    def __heartbeat(self):
+        """
+        Renew the node id lease, for as long as the process lives
+        """
+        while True:
+            time.sleep(self.leaseTTL / 3.0)
+            if self.leaseLost:
+                continue
             try:
-                return self.reservedIdsCache.popleft()
-            except IndexError: #queue is empty
-                self.__reserveIds()
-                return self.reservedIdsCache.popleft()
+                nodeId = self.nodeId
+                expires = time.time() + self.leaseTTL
+                if _renewLease(keys=(self.__nodeKey(nodeId),), args=(self.__token, self.leaseTTL),
+                               conn=self._getConnection('master')):
+                    if nodeId == self.nodeId:
+                        self.__leaseExpires = expires
+                elif nodeId == self.nodeId:
+                    logging.error("Lost the lease on node id %d for %s", nodeId, self.namespace)
+                    self.leaseLost = True
+            except Exception, e:
+                #a temporary failure - the lease is still valid until its TTL passes
+                logging.warn("Could not renew node id lease for %s: %s", self.namespace, e)
+
+    def __start(self):
+
+        self.nodeId = self.__leaseNodeId()
+        t = Thread(target=self.__heartbeat)
+        t.daemon = True
+        t.start()
+
+    @timed('idgen.timebased')
+    def getId(self):
+        """
+        Generate a new id. it only calls redis the first time, to lease the node id, and when the lease was lost
+        """
+        with self.__lock:
+            if self.nodeId is None:
+                self.__start()
 
+            now = time.time()
+            if self.leaseLost or now >= self.__leaseExpires:
+                #another process may own our node id by now
+                logging.warn("Node id lease %d for %s was lost, leasing a new one", self.nodeId, self.namespace)
+                self.nodeId = self.__leaseNodeId()
+                self.leaseLost = False
 
+            timestamp = int(now * 1000) - self.EPOCH
 
+            #the clock went back - wait for it to catch up rather than risk duplicates
+            while timestamp < self.__lastTimestamp:
+                time.sleep((self.__lastTimestamp - timestamp) / 1000.0)
+                timestamp = int(time.time() * 1000) - self.EPOCH
 
+            if timestamp == self.__lastTimestamp:
+                self.__sequence = (self.__sequence + 1) & self.maxSequence
+                #we've run out of sequence numbers for this millisecond, wait for the next one
+                if self.__sequence == 0:
+                    while timestamp <= self.__lastTimestamp:
+                        timestamp = int(time.time() * 1000) - self.EPOCH
+            else:
+                self.__sequence = 0
 
+            self.__lastTimestamp = timestamp
 
+            return (timestamp << (self.nodeBits + self.sequenceBits)) | (self.nodeId << self.sequenceBits) | self.__sequence
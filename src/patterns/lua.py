@@ -1,9 +1,134 @@
 import redis
-from redis.exceptions import RedisError
+from redis.exceptions import RedisError, NoScriptError
+from redis.client import BasePipeline
+from hashlib import sha1
+from threading import Lock
+
+from .. import instrumentation
+from ..instrumentation import timed, InstrumentedConnection
+
+
 class LuaScriptError(RedisError):
     pass
 
 
+def isNoScriptError(e):
+    """
+    Tell whether a redis error means the script is not cached on the server
+    """
+    #redis-py strips the NOSCRIPT prefix from the message when it raises NoScriptError
+    return isinstance(e, NoScriptError) or (isinstance(e, RedisError) and str(e).startswith('NOSCRIPT'))
+
+
+class ScriptRegistry(object):
+    """
+    A registry of all the lua scripts known to the process, identified by their locally computed SHA1.
+    It can preload all the scripts to a server in one round-trip, and execute pipelines with queued script calls,
+    reloading the scripts and replaying the failed calls if the server does not have them (e.g. after a restart)
+    Example:
+    >>> mult = LuaCall(lua_str) # registered in the default registry
+    >>> defaultRegistry.preload(conn)
+    >>> pipe = conn.pipeline(False)
+    >>> for i in xrange(100):
+    ...     mult(keys = ('foo%d' % i,), args = (i, 10), conn = pipe)
+    >>> print defaultRegistry.execute(pipe)
+    """
+
+    def __init__(self):
+
+        self.scripts = {}
+        self.__lock = Lock()
+
+    def register(self, source):
+        """
+        Add a script to the registry
+        @return the script's SHA1
+        """
+        sha = sha1(source).hexdigest()
+        with self.__lock:
+            self.scripts[sha] = source
+        return sha
+
+    def preload(self, conn):
+        """
+        Load all the registered scripts to the server of a connection, in a single round-trip
+        """
+        with self.__lock:
+            sources = self.scripts.values()
+
+        if not sources:
+            return
+
+        pipe = conn.pipeline(transaction=False)
+        for source in sources:
+            pipe.execute_command('SCRIPT', 'LOAD', source)
+        pipe.execute()
+
+    @timed('lua.pipeline')
+    def execute(self, pipe, conn = None):
+        """
+        Execute a pipeline that may contain script calls. If any of them fail because the script is not cached,
+        we load all the scripts and replay just the failed commands.
+        NOTE: in transactional pipelines the replayed commands are not part of the original transaction
+        @param pipe the pipeline
+        @param conn the connection to load scripts and replay on. defaults to the pipeline itself
+        @return the pipeline's results, just like pipe.execute()
+        """
+
+        commands = list(pipe.command_stack)
+        results = pipe.execute(raise_on_error=False)
+
+        failed = [idx for idx, res in enumerate(results) if isNoScriptError(res)]
+        if failed:
+            instrumentation.count('lua.noscript', len(failed))
+            conn = conn or pipe
+            self.preload(conn)
+
+            replay = conn.pipeline(transaction=False)
+            for idx in failed:
+                args, options = commands[idx]
+                replay.execute_command(*args, **options)
+
+            for idx, res in zip(failed, replay.execute(raise_on_error=False)):
+                results[idx] = res
+
+        for res in results:
+            if isinstance(res, Exception):
+                raise LuaScriptError("Could not execute pipeline: %s" % res)
+
+        return results
+
+
+class ScriptLoadingConnection(InstrumentedConnection):
+    """
+    A connection that loads all the scripts of a registry whenever it (re)connects to the server.
+    It is instrumented like the default connections of Rediston pools. Use it with a connection pool:
+    MyRediston.config(host, port, db, connectionClass=ScriptLoadingConnection), or
+    redis.ConnectionPool(connection_class=ScriptLoadingConnection, ...)
+    """
+
+    registry = None
+
+    def on_connect(self):
+
+        InstrumentedConnection.on_connect(self)
+
+        registry = self.registry or defaultRegistry
+        sources = registry.scripts.values()
+        for source in sources:
+            self.send_command('SCRIPT', 'LOAD', source)
+        for source in sources:
+            try:
+                self.read_response()
+            except redis.ResponseError:
+                #a broken script should not break the connection, it will fail when called
+                pass
+
+
+#The registry all LuaCalls are added to unless told otherwise
+defaultRegistry = ScriptRegistry()
+
+
 class LuaCall(object):
     """
     A class that helps you treat lua functions like they were actual functions.
@@ -17,40 +142,60 @@ class LuaCall(object):
     >>> print mult(keys = ('foo',), args = (3,10))
     30
 
+    Calls can also be queued on a pipeline, and executed with ScriptRegistry.execute()
     """
-    def __init__(self, sourceOrFile, redisConn = None):
+    def __init__(self, sourceOrFile, redisConn = None, registry = None):
         """
         construct the functin
         @param sourceOrFile either a lua string, or a reference to a file in read mode containing the source
         @param redisConn a redis connection. if not given here, you'll have to give it on each call (useful for master/slave)
+        @param registry the script registry to add the script to. defaults to defaultRegistry
         """
 
         self.source = sourceOrFile if type(sourceOrFile) == str else sourceOrFile.read()
         self.conn = redisConn
+        self.registry = registry or defaultRegistry
+
+        #the sha is computed locally, so we never need a round-trip to know it
+        self.sha = self.registry.register(self.source)
 
         #if a connection was given - try to preload the function. if not - it will have to be given later
         if self.conn:
             self.__load()
 
+    @timed('lua.call')
     def __call__(self,  keys=(), args=(), conn = None):
+        """
+        Call the script
+        @param conn a connection or a pipeline to use instead of the default connection.
+        if a pipeline is given, the call is queued and the pipeline is returned
+        """
+
+        #an empty pipeline is falsy
+        conn = conn if conn is not None else self.conn
+        keys = tuple(keys)
+        args = tuple(args)
+
+        if isinstance(conn, BasePipeline):
+            return conn.evalsha(self.sha, len(keys), *(keys + args))
 
-        conn = conn or self.conn
         #try to execute
         try:
             return conn.evalsha(self.sha, len(keys), *(keys + args))
         except RedisError, e:
             #check for script doesn't exist error
-            if e.message.startswith('NOSCRIPT'):
+            if isNoScriptError(e):
+                instrumentation.count('lua.noscript')
 
-                #try and reload
-                self.__load(conn)
+                #the server has lost its scripts - reload all of them, not just ours
+                self.registry.preload(conn)
 
                 #one more time, with feeling!
                 try:
 
                     return conn.evalsha(self.sha, len(keys), *(keys + args))
                 except redis.RedisError, e:
-                    raise LuaScriptError("Could not execute lua call: %s" % e.message)
+                    raise LuaScriptError("Could not execute lua call: %s" % e)
             else:
                 raise LuaScriptError(e)
 
@@ -60,16 +205,11 @@ class LuaCall(object):
         Silently preload the function to redis to be used in the future
         """
         conn = conn or self.conn
-        self.sha = conn.script_load(self.source)
+        conn.script_load(self.source)
 
     def isCached(self, conn = None):
         """
         Check if our function exists
         """
         conn = conn or self.conn
-        return conn.script_exists(self.sha)
-
-
-
-
-
+        return conn.script_exists(self.sha)[0]
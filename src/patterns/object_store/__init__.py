@@ -1,4 +1,4 @@
 __author__ = 'dvirsky'
 
-__all__ = ['condition', 'indexing', 'objects']
+__all__ = ['condition', 'indexing', 'objects', 'consistency']
 
@@ -54,11 +54,27 @@ class Condition(object):
 
     class Between(ConditionType):
         """
-        Range condition
+        Range condition. a bound of None is open (-inf/+inf), and each bound is inclusive unless marked exclusive
         """
-        def __init__(self, min, max):
+        def __init__(self, min, max, minExclusive = False, maxExclusive = False):
             self.min = min
             self.max = max
+            self.minExclusive = minExclusive
+            self.maxExclusive = maxExclusive
+
+    class GreaterThan(Between):
+        """
+        Open ended range condition, everything above a value (exclusive by default)
+        """
+        def __init__(self, value, exclusive = True):
+            Condition.Between.__init__(self, value, None, minExclusive = exclusive)
+
+    class LessThan(Between):
+        """
+        Open ended range condition, everything below a value (exclusive by default)
+        """
+        def __init__(self, value, exclusive = True):
+            Condition.Between.__init__(self, None, value, maxExclusive = exclusive)
 
     def __init__(self, fieldsAndValues, paging = None, order = 'ASC'):
         """
@@ -0,0 +1,247 @@
+#Copyright 2012 Do@. All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are
+#permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this list of
+#      conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice, this list
+#      of conditions and the following disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+#THIS SOFTWARE IS PROVIDED BY Do@ ``AS IS'' AND ANY EXPRESS OR IMPLIED
+#WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+#CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+#ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#The views and conclusions contained in the software and documentation are those of the
+#authors and should not be interpreted as representing official policies, either expressed
+#or implied, of Do@.
+
+from __future__ import absolute_import
+__author__ = 'dvirsky'
+
+import logging
+import time
+
+
+class IndexChecker(object):
+    """
+    Verifies, and optionally repairs, the indexes of an IndexedObject class against the objects themselves.
+    It only uses SCAN/ZSCAN/HSCAN and pipelined batches, pausing between batches, so it can run against a live
+    production instance without blocking it.
+    Three checks are available:
+     1. checkObjects - walk ids:<class>, and make sure every object has all the index entries it should have
+     2. checkIndex - walk the entries of a key, and find stale ones pointing to missing objects or old values
+     3. checkOrphans - walk the object hashes, and find objects missing from ids:<class>
+    Example:
+    >>> checker = IndexChecker(User, batchSize=200, pause=0.05, repair=True)
+    >>> print checker.run()
+    NOTE: repairs are best effort while the data is being changed, running a second pass confirms them
+    """
+
+    #problem types
+    MISSING_OBJECT = 'missing_object'
+    MISSING_ENTRY = 'missing_entry'
+    STALE_ENTRY = 'stale_entry'
+    UNIQUE_CONFLICT = 'unique_conflict'
+    ORPHAN_OBJECT = 'orphan_object'
+
+    def __init__(self, cls, batchSize = 500, pause = 0.01, repair = False):
+        """
+        @param cls the IndexedObject class to check
+        @param batchSize how many ids or entries are checked in each pipeline, also used as the SCAN COUNT hint
+        @param pause seconds to sleep between batches, to limit the load on redis
+        @param repair if True, missing entries are added and stale ones removed. otherwise we only report them
+        """
+        self.cls = cls
+        self.batchSize = batchSize
+        self.pause = pause
+        self.repair = repair
+        self.conn = cls._getConnection('master')
+
+        self.counts = {}
+        self.checked = 0
+
+    def _report(self, problem, *details):
+
+        self.counts[problem] = self.counts.get(problem, 0) + 1
+        logging.warn("%s: %s %s", self.cls.__name__, problem, details)
+
+    def _batches(self, iterator):
+        """
+        Group an iterator to lists of batchSize, pausing between them
+        """
+        batch = []
+        for item in iterator:
+            batch.append(item)
+            if len(batch) >= self.batchSize:
+                yield batch
+                batch = []
+                if self.pause:
+                    time.sleep(self.pause)
+        if batch:
+            yield batch
+
+    def checkObjects(self):
+        """
+        Walk all the object ids, and verify each object has all its index entries
+        """
+        keys = self.cls._keySpec.keys()
+
+        for batch in self._batches(self.conn.zscan_iter(self.cls._idsKey(), count=self.batchSize)):
+            ids = [id for id, score in batch]
+            objs = self.cls.loadObjects(ids, keepMissing=True)
+
+            pipe = self.conn.pipeline(transaction=False)
+            fixes = self.conn.pipeline(transaction=False)
+            expected = []
+            for id, obj in zip(ids, objs):
+                if obj is None:
+                    self._report(self.MISSING_OBJECT, id)
+                    if self.repair:
+                        fixes.zrem(self.cls._idsKey(), id)
+                    continue
+
+                for key in keys:
+                    for entry in obj._indexEntries(key):
+                        redisKey, member, score = entry
+                        if key.structure == key.T_HASH:
+                            pipe.hget(redisKey, member)
+                        else:
+                            pipe.zscore(redisKey, member)
+                        expected.append((key, obj, entry))
+
+            replies = pipe.execute() if expected else []
+            self.checked += len(ids)
+
+            for (key, obj, entry), actual in zip(expected, replies):
+                redisKey, member, score = entry
+                if key.structure == key.T_HASH:
+                    if actual is not None and actual != score:
+                        self._report(self.UNIQUE_CONFLICT, key, member, obj.id, actual)
+                        continue
+                    ok = actual == score
+                else:
+                    ok = actual is not None and (score is None or actual == score)
+
+                if not ok:
+                    self._report(self.MISSING_ENTRY, key, obj.id, redisKey, member)
+                    if self.repair:
+                        key.update(obj, fixes)
+
+            if self.repair and fixes.command_stack:
+                fixes.execute()
+
+    def _scanKeys(self, pattern):
+        """
+        Iterate the keys matching a pattern, pausing between SCAN pages. a literal key is only checked for existence
+        """
+        if not any(c in pattern for c in '*?[\\'):
+            if self.conn.exists(pattern):
+                yield pattern
+            return
+
+        cursor = '0'
+        while True:
+            cursor, keys = self.conn.scan(cursor, match=pattern, count=self.batchSize)
+            for redisKey in keys:
+                yield redisKey
+            if int(cursor) == 0:
+                break
+            if self.pause:
+                time.sleep(self.pause)
+
+    def _entries(self, key):
+        """
+        Iterate all the (redisKey, member, score) entries of a key
+        """
+        for pattern in key.scanPatterns():
+            for redisKey in self._scanKeys(pattern):
+                if key.structure == key.T_HASH:
+                    for member, value in self.conn.hscan_iter(redisKey, count=self.batchSize):
+                        yield redisKey, member, value
+                else:
+                    for member, score in self.conn.zscan_iter(redisKey, count=self.batchSize):
+                        yield redisKey, member, score
+
+    def checkIndex(self, key):
+        """
+        Walk all the entries of a key, and find entries pointing to missing objects or to values the objects no longer have
+        """
+        for batch in self._batches(self._entries(key)):
+            ids = [key.idFromEntry(member, score) for redisKey, member, score in batch]
+            objs = self.cls.loadObjects(ids, keepMissing=True)
+            self.checked += len(batch)
+
+            stale = []
+            for entry, id, obj in zip(batch, ids, objs):
+                redisKey, member, score = entry
+                if obj is None:
+                    stale.append(entry)
+                    continue
+
+                current = dict(((e[0], e[1]), e[2]) for e in obj._indexEntries(key))
+                isStale = (redisKey, member) not in current
+                if not isStale:
+                    #entries with a None score only need to exist
+                    expectedScore = current[(redisKey, member)]
+                    isStale = expectedScore is not None and expectedScore != score
+                if isStale:
+                    stale.append(entry)
+
+            for entry in stale:
+                self._report(self.STALE_ENTRY, key, entry)
+
+            if self.repair and stale:
+                pipe = self.conn.pipeline(transaction=False)
+                key.remove(stale, pipe)
+                pipe.execute()
+
+    def checkOrphans(self):
+        """
+        Walk all the object hashes, and find objects that are not in ids:<class>
+        """
+        idsKey = self.cls._idsKey()
+        prefixLen = len(self.cls._objectKey(''))
+
+        for batch in self._batches(self._scanKeys(self.cls._objectKey('*'))):
+            pipe = self.conn.pipeline(transaction=False)
+            for redisKey in batch:
+                pipe.type(redisKey)
+                pipe.zscore(idsKey, redisKey[prefixLen:])
+            replies = pipe.execute()
+            self.checked += len(batch)
+
+            fixes = self.conn.pipeline(transaction=False)
+            for idx, redisKey in enumerate(batch):
+                ktype, score = replies[2 * idx], replies[2 * idx + 1]
+                if ktype == 'hash' and score is None:
+                    id = redisKey[prefixLen:]
+                    self._report(self.ORPHAN_OBJECT, redisKey)
+                    if self.repair:
+                        try:
+                            fixes.zadd(idsKey, **{id: float(id)})
+                        except ValueError:
+                            logging.warn("Cannot add non numeric id %s to %s", id, idsKey)
+
+            if self.repair and fixes.command_stack:
+                fixes.execute()
+
+    def run(self):
+        """
+        Run all the checks
+        @return a dict of problem type => number of problems found
+        """
+        self.checkOrphans()
+        self.checkObjects()
+        for key in self.cls._keySpec.keys():
+            self.checkIndex(key)
+
+        return self.counts
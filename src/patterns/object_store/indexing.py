@@ -29,13 +29,49 @@ import string
 
 import codecs
 import re
+from ... import util
 from ...util import Rediston, InstanceCache
+from ...instrumentation import timed
 from .condition import Condition
-import pyhash
 import logging
 
+try:
+    import pyhash
+    _fnv1a_64 = pyhash.fnv1a_64()
+except ImportError:
+    pyhash = None
+    _fnv1a_64 = None
+
+
+def fnv1a_64(data):
+    """
+    64 bit FNV-1a hash of a string. uses pyhash if it is installed, and a pure python implementation otherwise
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+
+    if _fnv1a_64 is not None:
+        return _fnv1a_64(data)
+
+    h = 0xcbf29ce484222325
+    for c in data:
+        h = ((h ^ ord(c)) * 0x100000001b3) & 0xffffffffffffffff
+    return h
+
 
 class AbstractKey(object):
+    """
+    Base class of all keys. keys read the values of objects with obj[field], which both plain dicts (e.g. the
+    values of a condition) and IndexedObject instances support
+    """
+
+    #set to True in keys that can return false positives, so the ids they find are checked against the objects
+    needsVerification = False
+
+    #the redis type of the key's index entries
+    T_ZSET = 'zset'
+    T_HASH = 'hash'
+    structure = T_ZSET
 
     def __init__(self, prefix,fields):
 
@@ -44,17 +80,86 @@ class AbstractKey(object):
         self.fieldSet = set(fields)
 
 
+    def matches(self, queryFields):
+        """
+        Tell whether this key can answer a query on exactly these fields
+        @param queryFields a set of the fields in the query
+        """
+        return queryFields == self.fieldSet
+
     def update(self, obj, pipeline = None):
         pass
 
     def updateMany(self, idsAndKeyValues = ()):
         pass
 
+    def count(self, condition):
+        """
+        Count the objects matching a condition. keys that can do it without fetching ids override this
+        """
+        return len(self.find(condition))
+
+    def entries(self, obj):
+        """
+        Get the index entries an object should have in this key
+        @return a list of (redisKey, member, score) tuples. for hash based keys, member is the hash field and score
+        is its value. a score of None matches any score
+        """
+        return []
+
+    def scanPatterns(self):
+        """
+        Get the redis keys holding this key's entries, as SCAN MATCH patterns
+        """
+        return []
+
+    def idFromEntry(self, member, score):
+        """
+        Get the object id an index entry points to
+        """
+        return member
+
+    def remove(self, entries, pipeline):
+        """
+        Queue the removal of index entries, as returned by entries(), on a pipeline
+        """
+        for redisKey, member, score in entries:
+            if self.structure == self.T_HASH:
+                pipeline.hdel(redisKey, member)
+            else:
+                pipeline.zrem(redisKey, member)
+
     def __repr__(self):
 
         return '%s(%s:%s)' % (self.__class__.__name__, self.prefix, ','.join(self.fields))
 
 
+def _scoreBound(value, exclusive, infinity):
+
+    if value is None or value in ('-inf', '+inf', 'inf'):
+        return infinity
+
+    if exclusive:
+        return '(%r' % float(value)
+
+    return float(value)
+
+
+def scoreRange(conditionValue):
+    """
+    Translate a condition value on a numeric field to a (min, max) pair of sorted set scores,
+    to be used with ZRANGEBYSCORE and friends
+    @param conditionValue either a plain value, a Condition.Is or a Condition.Between. ranges can be open or exclusive
+    """
+    if isinstance(conditionValue, Condition.Between):
+        return (_scoreBound(conditionValue.min, conditionValue.minExclusive, '-inf'),
+                _scoreBound(conditionValue.max, conditionValue.maxExclusive, '+inf'))
+    elif isinstance(conditionValue, Condition.ConditionType):
+        return float(conditionValue.value), float(conditionValue.value)
+
+    return float(conditionValue), float(conditionValue)
+
+
 class FullTextKey(AbstractKey, Rediston):
     '''
     classdocs
@@ -86,34 +191,54 @@ class FullTextKey(AbstractKey, Rediston):
         return str_.translate(self.trantab, self.stopchars)
         
         
-    def update(self, obj, pipeline = None):
-
+    def tokenScores(self, obj):
+        """
+        Split the object's fields to normalized tokens
+        @return a dict of token => score
+        """
         score = 1.0
 
         #if the object suppports scoring, call the callback now
         if self.scoringCallback:
             score = self.scoringCallback(obj)
 
-        pipe = pipeline or self._getPipeline(transaction=False)
         indexKeys = {}
         #split the words
         for field, factor in self.fieldSpec.iteritems():
 
-            for token in re.split(self.delimiter, getattr(obj, field, '')):
+            for token in re.split(self.delimiter, getattr(obj, field, '') or ''):
                 
                 t = self.normalizeString(token.lower().strip())
                 
                 if t:
                     indexKeys[t]= indexKeys.get(t, 0) + float(factor)*score
 
+        return indexKeys
+
+    @timed('key.fulltext.update')
+    def update(self, obj, pipeline = None):
+
+        pipe = pipeline or self._getPipeline(transaction=False)
+        indexKeys = self.tokenScores(obj)
+
         for x in indexKeys:
 
             pipe.zadd(self.getKey(x), obj.id, indexKeys[x])
 
         if not pipeline:
             pipe.execute()
+
+    def entries(self, obj):
+
+        #token scores depend on the scoring callback, so we only check membership
+        return [(self.getKey(t), str(obj.id), None) for t in self.tokenScores(obj)]
+
+    def scanPatterns(self):
+
+        return [self.getKey('*')]
             
         
+    @timed('key.fulltext.find')
     def find(self, condition):
 
 
@@ -139,15 +264,18 @@ class FullTextKey(AbstractKey, Rediston):
 class UnorderedKey(AbstractKey, Rediston):
     """
     A simple catch all key, non unique, ideal for short texts (emails, etc). case sensitive.
-    it uses hashing of the value as a score in a sorted set
+    it uses hashing of the value as a score in a sorted set.
+    Since different values can hash to the same score, the objects found are verified against the query by default.
+    See LexicalKey for an exact alternative that does not need verification
     """
-    def __init__(self, prefix, fields):
+    def __init__(self, prefix, fields, verify = True):
         '''
         Constructor
+        @param verify if True, ids found by the key are checked against the actual object values to filter out hash collisions
         '''
         AbstractKey.__init__(self, prefix, fields)
         Rediston.__init__(self)
-        self.hasher = pyhash.fnv1a_64()
+        self.needsVerification = verify
 
 
     def getValue(self, _dict):
@@ -155,10 +283,11 @@ class UnorderedKey(AbstractKey, Rediston):
 
         vals = '::'.join(('%s' % _dict[f] for f in self.fields))
 
-        #make a hash val that is 52 bits and can fit as a sorted set score
-        hashval = self.hasher(vals) & 0b11111111111111111111111111111111111111111111111111111
+        #make a hash val that is 53 bits and can fit as a sorted set score
+        hashval = fnv1a_64(vals) & 0b11111111111111111111111111111111111111111111111111111
 
-        logging.info("Vals for key %s: %s. hashval: %s", self, vals, hashval)
+        if util.DEBUG:
+            logging.debug("Vals for key %s: %s. hashval: %s", self, vals, hashval)
 
         return hashval
 
@@ -167,15 +296,24 @@ class UnorderedKey(AbstractKey, Rediston):
 
         return 'k:%s:%s' % (self.prefix, ','.join(self.fields))
 
+    @timed('key.unordered.update')
     def update(self, obj, pipeline = None):
         """
         Update the key with the value of this object
         """
 
-        hashval = self.getValue(obj.__dict__)
+        hashval = self.getValue(obj)
         conn = pipeline or self._getConnection('master')
         conn.zadd(self.redisKey(), **{str(obj.id): hashval})
 
+    def entries(self, obj):
+
+        return [(self.redisKey(), str(obj.id), float(self.getValue(obj)))]
+
+    def scanPatterns(self):
+
+        return [self.redisKey()]
+
 
 
     def updateMany(self, ids, cls):
@@ -187,12 +325,14 @@ class UnorderedKey(AbstractKey, Rediston):
         updateDict = {}
         for obj in objs:
             if obj:
-                updateDict[obj.id] = self.getValue(obj.__dict__)
+                updateDict[str(obj.id)] = self.getValue(obj)
 
-        conn = self._getConnection('master')
-        conn.zadd(self.redisKey(), **updateDict)
+        if updateDict:
+            conn = self._getConnection('master')
+            conn.zadd(self.redisKey(), **updateDict)
 
 
+    @timed('key.unordered.find')
     def find(self, condition):
         """
         find objects matching  a certian condition
@@ -201,8 +341,95 @@ class UnorderedKey(AbstractKey, Rediston):
         hashval = self.getValue(condition.fieldsAndValues)
         conn = self._getConnection()
         return conn.zrangebyscore(self.redisKey(), min=hashval,max=hashval,
-                                    start = 0 if not condition.paging else condition.paging[0],
-                                    num = -1 if not condition.paging else condition.paging[0] + condition.paging[1] )
+                                    start = None if not condition.paging else condition.paging[0],
+                                    num = None if not condition.paging else condition.paging[1])
+
+
+
+class LexicalKey(AbstractKey, Rediston):
+    """
+    An exact match key, non unique, for short texts. case sensitive.
+    All the entries are kept in one sorted set with the same score, as "value\\0id" members, so a lookup
+    is a single ZRANGEBYLEX on the value prefix - O(log(N)+M), with no false positives and cheap paging.
+    Requires redis 2.8.9 or higher
+    """
+
+    SEPARATOR = '\0'
+
+    def __init__(self, prefix, fields):
+        '''
+        Constructor
+        '''
+        AbstractKey.__init__(self, prefix, fields)
+        Rediston.__init__(self)
+
+
+    def getValue(self, _dict):
+
+        #members are compared as the UTF-8 bytes redis keeps, so the value is built as bytes too
+        return '::'.join((_dict[f].encode('utf-8') if isinstance(_dict[f], unicode) else '%s' % _dict[f]
+                          for f in self.fields))
+
+    def getMember(self, _dict, id):
+
+        return '%s%s%s' % (self.getValue(_dict), self.SEPARATOR, id)
+
+    @InstanceCache
+    def redisKey(self):
+
+        return 'lk:%s:%s' % (self.prefix, ','.join(self.fields))
+
+    @timed('key.lexical.update')
+    def update(self, obj, pipeline = None):
+        """
+        Update the key with the value of this object
+        """
+        conn = pipeline or self._getConnection('master')
+        conn.zadd(self.redisKey(), **{self.getMember(obj, obj.id): 0})
+
+    def entries(self, obj):
+
+        return [(self.redisKey(), self.getMember(obj, obj.id), 0.0)]
+
+    def scanPatterns(self):
+
+        return [self.redisKey()]
+
+    def idFromEntry(self, member, score):
+
+        return member.rsplit(self.SEPARATOR, 1)[-1]
+
+
+    def updateMany(self, ids, cls, pipeline = None):
+
+        #first, get the values for these ids
+        objs = cls.loadObjects(ids, *self.fields)
+
+        updateDict = {}
+        for obj in objs:
+            if obj:
+                updateDict[self.getMember(obj, obj.id)] = 0
+
+        if updateDict:
+            conn = pipeline or self._getConnection('master')
+            conn.zadd(self.redisKey(), **updateDict)
+
+
+    @timed('key.lexical.find')
+    def find(self, condition):
+        """
+        find objects matching  a certian condition
+        currently the condition has to be exactly field=value. no multiple options and no ranges allowed
+        """
+        prefix = self.getValue(condition.fieldsAndValues) + self.SEPARATOR
+        conn = self._getConnection()
+
+        #all the members of this value are between "value\0" inclusive and "value\1" exclusive
+        members = conn.zrangebylex(self.redisKey(), '[%s' % prefix, '(%s\1' % prefix[:-1],
+                                   start = None if not condition.paging else condition.paging[0],
+                                   num = None if not condition.paging else condition.paging[1])
+
+        return [self.idFromEntry(m, 0) for m in members]
 
 
 
@@ -228,14 +455,23 @@ class OrderedNumericalKey(AbstractKey, Rediston):
 
         return 'ok:%s:%s' % (self.prefix, ','.join(self.fields))
 
+    @timed('key.numeric.update')
     def update(self, obj, pipeline = None):
         """
         Update the key with the value of this object
         """
-        val = self.getValue(obj.__dict__)
+        val = self.getValue(obj)
         conn = pipeline or self._getConnection('master')
         conn.zadd(self.redisKey(), **{str(obj.id): val})
 
+    def entries(self, obj):
+
+        return [(self.redisKey(), str(obj.id), self.getValue(obj))]
+
+    def scanPatterns(self):
+
+        return [self.redisKey()]
+
 
 
     def updateMany(self, ids, cls):
@@ -247,34 +483,35 @@ class OrderedNumericalKey(AbstractKey, Rediston):
         updateDict = {}
         for obj in objs:
             if obj:
-                updateDict[obj.id] = self.getValue(obj.__dict__)
+                updateDict[str(obj.id)] = self.getValue(obj)
 
-        conn = self._getConnection('master')
-        conn.zadd(self.redisKey(), **updateDict)
+        if updateDict:
+            conn = self._getConnection('master')
+            conn.zadd(self.redisKey(), **updateDict)
 
 
+    @timed('key.numeric.find')
     def find(self, condition):
         """
         find objects matching  a certian condition
-        currently the condition has to be exactly field=value. no multiple options and no ranges allowed
+        the condition can be a value or a range (see Condition.Between), ordered by condition.order
+        and paged by condition.paging
         """
-
-        _min = None
-        _max = None
-        conditionValue = condition.getValuesFor(self.field)[0]
-        #if this is a range query, get the min/max of the query
-        if isinstance(conditionValue, Condition.Between):
-            _min = float(conditionValue.min)
-            _max = float(conditionValue.max)
-        elif isinstance(conditionValue, Condition.ConditionType):
-            _min = _max = float(conditionValue.value)
-        else:
-            _min = _max = float(conditionValue)
+        _min, _max = scoreRange(condition.getValuesFor(self.field)[0])
+        start, num = (condition.paging[0], condition.paging[1]) if condition.paging else (None, None)
 
         conn = self._getConnection()
-        return conn.zrangebyscore(self.redisKey(), min=_min,max=_max,
-            start = 0 if not condition.paging else condition.paging[0],
-            num = -1 if not condition.paging else condition.paging[0] + condition.paging[1] )
+        if condition.order == 'DESC':
+            return conn.zrevrangebyscore(self.redisKey(), _max, _min, start=start, num=num)
+
+        return conn.zrangebyscore(self.redisKey(), _min, _max, start=start, num=num)
+
+    def count(self, condition):
+        """
+        Count the objects matching a condition without fetching their ids. paging is ignored
+        """
+        _min, _max = scoreRange(condition.getValuesFor(self.field)[0])
+        return self._getConnection().zcount(self.redisKey(), _min, _max)
 
 
 
@@ -290,6 +527,9 @@ class UniqueKey(AbstractKey, Rediston):
     It uses a HASH of value=>objectId to make sure no two objects have the same value
     it raises UniqueKeyDuplicateError if you hit a duplicate value
     """
+
+    structure = AbstractKey.T_HASH
+
     def __init__(self, prefix, fields):
         '''
         Constructor
@@ -303,18 +543,31 @@ class UniqueKey(AbstractKey, Rediston):
 
         return '::'.join(('%s' % _dict[f] for f in self.fields))
 
+    def entries(self, obj):
+
+        return [(self.redisKey(), self.getValue(obj), str(obj.id))]
+
+    def scanPatterns(self):
+
+        return [self.redisKey()]
+
+    def idFromEntry(self, member, score):
+
+        return score
+
     @InstanceCache
     def redisKey(self):
 
         return 'uk:%s:%s' % (self.prefix, ','.join(self.fields))
 
 
+    @timed('key.unique.update')
     def update(self, obj, pipeline = None):
         """
         Update the key with the value of this object
         """
 
-        val = self.getValue(obj.__dict__)
+        val = self.getValue(obj)
         pipe = self._getPipeline('master')
 
         #we set and check the value at once, in case the key is already taken we need to check the current object...
@@ -325,15 +578,13 @@ class UniqueKey(AbstractKey, Rediston):
         #this means
         if rx[0] == 0:
             currentObjId= rx[1]
-            logging.info("Possible unique key collision, checking... object: %s, current in key: %s", obj.id, currentObjId)
-
             if currentObjId != '%s' % obj.id:
                 logging.warn("Unique Key collision. wanted to set %s but key already has %s", obj, currentObjId)
                 raise UniqueKeyDuplicateError("Duplicate error for key %s" % self)
-            else:
-                logging.info("Unique key set to the same object")
-        else:
-            logging.info("Unique key %s set new value for %s:%s", self, obj.id, val)
+            elif util.DEBUG:
+                logging.debug("Unique key set to the same object")
+        elif util.DEBUG:
+            logging.debug("Unique key %s set new value for %s:%s", self, obj.id, val)
 
     def updateMany(self, ids, cls):
 
@@ -349,6 +600,7 @@ class UniqueKey(AbstractKey, Rediston):
 
 
 
+    @timed('key.unique.find')
     def find(self, condition):
         """
         find objects matching  a certian condition
@@ -364,8 +616,10 @@ class UniqueKey(AbstractKey, Rediston):
 
 class OrderedCompoundKey(AbstractKey, Rediston):
     """
-    A simple catch all key, non unique, ideal for short texts (emails, etc). case sensitive.
-    it uses hashing of the value as a score in a sorted set
+    A composite index: equality on one or more prefix fields, ordered and ranged by a numeric order field.
+    Each combination of prefix values gets its own sorted set, scored by the order field, so queries like
+    "the latest N items of owner X" are a single ZRANGEBYSCORE/ZREVRANGEBYSCORE with LIMIT.
+    The key can be queried by the prefix fields alone, or by the prefix fields plus a condition on the order field
     """
     def __init__(self, prefix, fields, orderField):
         '''
@@ -374,7 +628,14 @@ class OrderedCompoundKey(AbstractKey, Rediston):
         AbstractKey.__init__(self, prefix, fields)
         Rediston.__init__(self)
         self.orderField = orderField
+        self.prefixFieldSet = frozenset(fields)
+        #changes to the order field must also trigger an update of this key
+        self.fieldSet = set(fields) | set((orderField,))
+
+
+    def matches(self, queryFields):
 
+        return queryFields == self.prefixFieldSet or queryFields == self.fieldSet
 
     def getValue(self, _dict):
 
@@ -383,44 +644,79 @@ class OrderedCompoundKey(AbstractKey, Rediston):
 
         return vals
 
+    def getScore(self, _dict):
+
+        return float(_dict[self.orderField])
+
+    @timed('key.compound.update')
     def update(self, obj, pipeline = None):
         """
         Update the key with the value of this object
         """
 
-        redisKey = self.getValue(obj.__dict__)
-        score = getattr(obj, self.orderField)
+        redisKey = self.getValue(obj)
+        score = self.getScore(obj)
         conn = pipeline or self._getConnection('master')
         conn.zadd(redisKey, **{str(obj.id): score})
 
+    def entries(self, obj):
 
-    def updateMany(self, ids, cls):
+        return [(self.getValue(obj), str(obj.id), self.getScore(obj))]
 
-        #first, get the values for these ids
+    def scanPatterns(self):
 
-        objs = cls.loadObjects(ids, *(self.fields+ self.orderField))
+        return ['ck:%s/%s/*' % (self.prefix, self.orderField)]
 
-        #build a dictionary of all the values to be updated
-        updates = []
-        pipe = self._getPipeline('master')
+
+    def updateMany(self, ids, cls, pipeline = None):
+        """
+        Re-index many objects at once. all the writes are sent in a single pipeline
+        @param ids the ids of the objects to update
+        @param cls the IndexedObject class of the objects
+        @param pipeline optional pipeline to queue the writes on. if given, it is not executed here
+        """
+
+        #first, get the values for these ids
+        objs = cls.loadObjects(ids, *(tuple(self.fields) + (self.orderField,)))
+
+        pipe = pipeline or self._getPipeline('master')
         for obj in objs:
             if obj:
-                pipe.zadd( self.getValue(obj.__dict__), **{obj.id: getattr(obj, self.orderField)})
+                pipe.zadd(self.getValue(obj), **{str(obj.id): self.getScore(obj)})
 
-        pipe.execute()
+        if not pipeline:
+            pipe.execute()
 
 
+    @timed('key.compound.find')
     def find(self, condition):
         """
         find objects matching  a certian condition
-        currently the condition has to be exactly field=value. no multiple options and no ranges allowed
+        the prefix fields must be exactly field=value. the order field, if present, can be a value or a range
+        results are ordered by the order field according to condition.order, and paged by condition.paging
         """
         redisKey = self.getValue(condition.fieldsAndValues)
+
+        _min, _max = '-inf', '+inf'
+        if self.orderField in condition.fieldsAndValues:
+            _min, _max = scoreRange(condition.getValuesFor(self.orderField)[0])
+
+        start, num = (condition.paging[0], condition.paging[1]) if condition.paging else (None, None)
+
         conn = self._getConnection()
-        if (condition.order == 'ASC'):
-            return conn.zrevrange(redisKey, 0 if not condition.paging else condition.paging[0],
-                                     -1 if not condition.paging else condition.paging[0] + condition.paging[1] )
-        else:
-            return conn.zrevrange(redisKey, 
-                                     0 if not condition.paging else condition.paging[0],
-                                    -1 if not condition.paging else condition.paging[0] + condition.paging[1] )
\ No newline at end of file
+        if condition.order == 'DESC':
+            return conn.zrevrangebyscore(redisKey, _max, _min, start=start, num=num)
+
+        return conn.zrangebyscore(redisKey, _min, _max, start=start, num=num)
+
+    def count(self, condition):
+        """
+        Count the objects matching a condition without fetching their ids. paging is ignored
+        """
+        redisKey = self.getValue(condition.fieldsAndValues)
+
+        _min, _max = '-inf', '+inf'
+        if self.orderField in condition.fieldsAndValues:
+            _min, _max = scoreRange(condition.getValuesFor(self.orderField)[0])
+
+        return self._getConnection().zcount(redisKey, _min, _max)
@@ -28,8 +28,12 @@ from __future__ import absolute_import
 __author__ = 'dvirsky'
 
 import logging
+from ... import util
 from ...util import  InstanceCache, Rediston
+from ... import instrumentation
+from ...instrumentation import timed, InstrumentedConnection
 from ..idgenerator import IncrementalIdGenerator
+from .condition import Condition
 
 
 class KeySpec(object):
@@ -42,6 +46,8 @@ class KeySpec(object):
         @param keys all the keys to be included in this spec
         """
         self._keys = list(keys)
+        #maps the frozenset of a query's fields to the key serving it, filled on first use of each field set
+        self._keysByFields = {}
 
 
     def getKey(self, condition):
@@ -50,13 +56,18 @@ class KeySpec(object):
         TODO: Support multiple keys for a single query to be crossed
         @param condition a condition object
         """
-        queryKeys = set(condition.fieldsAndValues.iterkeys())
-        logging.info("Query keys: %s", queryKeys)
+        queryKeys = frozenset(condition.fieldsAndValues)
+        key = self._keysByFields.get(queryKeys)
+        if key is not None:
+            return key
 
+        #compound keys match more than one field set, so we ask the keys rather than indexing their fields up front
         for key in self._keys:
 
-            if queryKeys == key.fieldSet:
-                logging.info("Found key for condition: %s", key)
+            if key.matches(queryKeys):
+                if util.DEBUG:
+                    logging.debug("Found key for query keys %s: %s", queryKeys, key)
+                self._keysByFields[queryKeys] = key
                 return key
 
         raise ValueError("Could not find key for condition %s", condition)
@@ -74,8 +85,34 @@ class KeySpec(object):
 
 
 
+class IndexedObjectMeta(type):
+    """
+    Generates __slots__ from _spec for object classes that set _slotted = True
+    """
+
+    def __new__(mcs, name, bases, attrs):
+
+        slotted = attrs.get('_slotted', any(getattr(b, '_slotted', False) for b in bases))
+        if slotted and '__slots__' not in attrs:
+            spec = attrs.get('_spec') or next((b._spec for b in bases if hasattr(b, '_spec')), ())
+
+            #slots already defined by base classes can't be redefined
+            inherited = set()
+            for b in bases:
+                for c in b.__mro__:
+                    inherited.update(c.__dict__.get('__slots__', ()))
+
+            slots = tuple(spec) + ('_raw', '_rawIndex') + tuple(attrs.get('_extraSlots', ()))
+            attrs['__slots__'] = tuple(s for s in slots if s not in inherited)
+
+        return type.__new__(mcs, name, bases, attrs)
+
+
 class IndexedObject(Rediston):
 
+    __metaclass__ = IndexedObjectMeta
+    __slots__ = ()
+
 
     #This is the specification of which fields you want to index. override in child classes
     _keySpec = KeySpec()
@@ -83,8 +120,29 @@ class IndexedObject(Rediston):
     #this is the specification of which fields should be saved to redis
     _spec = ('id',)
 
+    #optional decoders of field values loaded from redis, e.g. {'score': int}. fields not listed here are loaded as strings
+    _types = {}
+
+    #if True, fields are saved under short aliases (their position in _spec) and None values are not saved at all.
+    #this keeps object hashes small and in their compact encoding. NOTE: in compact mode, only append fields to _spec
+    _compact = False
+
+    #if True, instances have slots for the _spec fields instead of a __dict__, and loaded objects decode their fields
+    #only when they are first accessed. this saves a lot of memory when loading many objects.
+    #NOTE: slotted instances can only have the _spec fields, plus any field names listed in _extraSlots,
+    #and loadObjects does not call __init__ for them
+    _slotted = False
+    _extraSlots = ()
+
+    #how many objects loadObjects gets in a single pipeline
+    _loadChunkSize = 1000
+
+    #how many candidates more than a page needs are verified at once, for keys with false positives
+    _verifySlack = 10
+
     #the id generator for the class. by default it is initialized to an incremental id generator
-    #you can replace it with another id generator if you want
+    #you can replace it with another id generator if you want, e.g. a TimeBasedIdGenerator that doesn't need
+    #a central redis counter
     _idGenerator = None
 
 
@@ -93,7 +151,11 @@ class IndexedObject(Rediston):
         default constructor, override in subclasses to force strict field typing
         """
         self.id = kwargs.get('id', None)
-        self.__dict__.update(kwargs)
+        if self._slotted:
+            for k, v in kwargs.iteritems():
+                setattr(self, k, v)
+        else:
+            self.__dict__.update(kwargs)
 
         #create id generator the first time needed. this can be overriden in child classes
         if not self.__class__._idGenerator:
@@ -136,65 +198,218 @@ class IndexedObject(Rediston):
         return '%s:%s' % (cls.__name(), id)
 
     @classmethod
-    def config(cls, host, port, db, timeout = None):
+    def config(cls, host, port, db, timeout = None, connectionClass = None):
 
         for k in cls._keySpec.keys():
-            k.__class__.config(host, port, db, timeout)
+            k.__class__.config(host, port, db, timeout, connectionClass)
 
         cls._host = host
         cls._port = port
         cls._db = db
         cls._timeout = timeout
+        cls._connectionClass = connectionClass or InstrumentedConnection
 
 
         cls.__connPool = None
 
     @classmethod
-    def loadObjects(cls, ids, *fields):
+    def __aliases(cls):
         """
-        Load a list of objects by ids
-        @param ids a list of object ids (not keys)
-        @param fields optional list of fields to pass if you do not want ALL the object
+        The mapping of field names to their hash fields in redis, and back
         """
+        if '_aliasMaps' not in cls.__dict__:
+            if cls._compact:
+                toAlias = {f: '%x' % idx for idx, f in enumerate(cls._spec)}
+            else:
+                toAlias = {f: f for f in cls._spec}
+            cls._aliasMaps = (toAlias, {a: f for f, a in toAlias.iteritems()})
 
-        p = cls._getPipeline()
+        return cls._aliasMaps
 
-        if not fields:
+    @classmethod
+    def _hashFields(cls, fields):
+        """
+        Translate field names to the hash fields they are saved under
+        """
+        toAlias = cls.__aliases()[0]
+        return [toAlias.get(f, f) for f in fields]
 
-            [p.hgetall(cls.__key(id)) for id in ids]
-        else:
-            #we get the id anyway,no point in getting it from redis
-            if 'id' in fields:
-                fields.remove('id')
-            [p.hmget(cls.__key(id), fields) for id in ids]
+    @classmethod
+    def _encode(cls, fieldsAndValues):
+        """
+        Translate a dict of field values to the dict to be saved in the object's hash
+        """
+        toAlias = cls.__aliases()[0]
+        return {toAlias.get(f, f): v for f, v in fieldsAndValues.iteritems() if not (cls._compact and v is None)}
 
-        ret = p.execute()
+    @classmethod
+    def _decodeValue(cls, field, value):
+        """
+        Convert a value loaded from redis to its declared type
+        """
+        decoder = cls._types.get(field)
+        if decoder is None or value is None:
+            return value
+        #None values of non compact objects are saved as the string 'None'
+        if value == 'None':
+            return None
+        return decoder(value)
 
-        objs = []
-        for idx,r in enumerate(ret):
-            if r:
-                if fields:
-                    # converting to dict since hmget returns lists
-                    r = dict(zip(fields, r))
-
-                r['id'] = ids[idx]
-                obj = cls( **r)
+    @classmethod
+    def _decode(cls, hashValues):
+        """
+        Translate the contents of an object's hash to a dict of typed field values
+        """
+        fromAlias = cls.__aliases()[1]
+        ret = {}
+        for k, v in hashValues.iteritems():
+            f = fromAlias.get(k, k)
+            ret[f] = cls._decodeValue(f, v)
+        return ret
+
+    @classmethod
+    def __write(cls, conn, id, fieldsAndValues):
+        """
+        Write field values to an object's hash
+        @param conn a connection or a pipeline
+        """
+        encoded = cls._encode(fieldsAndValues)
+        ret = conn.hmset(cls.__key(id), encoded) if encoded else True
+
+        if cls._compact:
+            #None values are not saved in compact mode, so make sure old values are gone
+            nones = [k for k, v in fieldsAndValues.iteritems() if v is None]
+            if nones:
+                conn.hdel(cls.__key(id), *cls._hashFields(nones))
+
+        return ret
+
+    @classmethod
+    @timed('object.load')
+    def loadObjects(cls, ids, *fields, **kwargs):
+        """
+        Load a list of objects by ids
+        @param ids a list of object ids (not keys)
+        @param fields optional list of fields to pass if you do not want ALL the object. if only the id is asked for,
+        nothing is fetched from redis, and the objects are not checked for existence. partial objects are built without
+        calling __init__, like slotted ones
+        @param keepMissing keyword only. if True, the returned list is aligned with ids, with None for objects that do
+        not exist. otherwise they are left out of it, and are only counted and logged
+        """
+        keepMissing = kwargs.get('keepMissing', False)
+        ids = list(ids)
+
+        #we get the id anyway,no point in getting it from redis
+        projected = [f for f in fields if f != 'id']
+        if fields and not projected:
+            objs = []
+            for id in ids:
+                obj = cls.__new__(cls)
+                obj.id = cls._decodeValue('id', id)
                 objs.append(obj)
+            return objs
+
+        #slotted objects always load fields by position, for the whole spec if no projection was asked for
+        if cls._slotted and not projected:
+            projected = [f for f in cls._spec if f != 'id']
+
+        hashFields = cls._hashFields(projected)
+        #we get the id field as well, to tell missing objects from objects with missing fields
+        idField = cls._hashFields(('id',))[0]
+        rawIndex = {f: idx for idx, f in enumerate(projected)}
+
+        objs = []
+        missing = []
+        #large lists are split into several pipelines, so one huge reply doesn't block the connection
+        for start in xrange(0, len(ids), cls._loadChunkSize):
+            chunk = ids[start:start + cls._loadChunkSize]
+
+            p = cls._getPipeline()
+            if projected:
+                [p.hmget(cls.__key(id), hashFields + [idField]) for id in chunk]
+            else:
+                [p.hgetall(cls.__key(id)) for id in chunk]
+
+            for id, r in zip(chunk, p.execute()):
+
+                obj = None
+                if not projected:
+                    if r:
+                        r = cls._decode(r)
+                        r['id'] = cls._decodeValue('id', id)
+                        obj = cls(**r)
+                elif any(v is not None for v in r):
+                    if cls._slotted:
+                        obj = cls.__new__(cls)
+                        obj._raw = tuple(r[:-1])
+                        obj._rawIndex = rawIndex
+                        obj.id = cls._decodeValue('id', id)
+                    else:
+                        #partial objects are not passed to __init__, which may require or default other fields
+                        obj = cls.__new__(cls)
+                        obj.__dict__.update((f, cls._decodeValue(f, v)) for f, v in zip(projected, r))
+                        obj.id = cls._decodeValue('id', id)
+
+                if obj is None:
+                    missing.append(id)
+                if obj is not None or keepMissing:
+                    objs.append(obj)
+
+        if missing:
+            instrumentation.count('object.missing', len(missing))
+            logging.warn("%d of %d %s objects requested do not exist: %s", len(missing), len(ids), cls.__name(),
+                         ', '.join('%s' % id for id in missing[:10]) + (' ...' if len(missing) > 10 else ''))
+
         return objs
 
+    def __getattr__(self, name):
+        """
+        Lazy hydration of slotted objects: decode a field from the raw redis reply the first time it is accessed
+        """
+        if name in ('_raw', '_rawIndex'):
+            raise AttributeError(name)
+
+        idx = getattr(self, '_rawIndex', {}).get(name)
+        if idx is None:
+            raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+
+        value = self._decodeValue(name, self._raw[idx])
+        setattr(self, name, value)
+        return value
+
+    def __getitem__(self, field):
+        """
+        Field accessor used by the keys to read the values they index
+        """
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def _fields(self):
+        """
+        Get a dict of the object's fields
+        """
+        if not self._slotted:
+            return self.__dict__
+
+        return {f: getattr(self, f) for f in self._spec if hasattr(self, f)}
 
     def __repr__(self):
 
-        return '%s(%s)' % (self.__class__.__name__, self.__dict__)
+        return '%s(%s)' % (self.__class__.__name__, self._fields())
 
     @classmethod
     def getAll(cls, first = 0, num = -1, *fields):
         """
         Get all the objects of a given type, with optional paging
+        @param first the offset of the first object
+        @param num how many objects to get, -1 for all of them
+        @param fields optional list of fields to load if you do not want ALL the object
         """
         redisConn = cls._getConnection()
-        ids = redisConn.zrange(cls.__classKey(), first, num)
-        return cls.loadObjects(ids, redisConn, *fields)
+        ids = redisConn.zrange(cls.__classKey(), first, first + num - 1 if num > 0 else -1)
+        return cls.loadObjects(ids, *fields)
 
 
 
@@ -231,6 +446,7 @@ class IndexedObject(Rediston):
             self.id = self.__createId()
         return self.id
 
+    @timed('object.save')
     def save(self):
 
         #redisConn = self._getConnection('master')
@@ -240,7 +456,7 @@ class IndexedObject(Rediston):
 
         pipe =self._getPipeline('master', True)
         #save all properties
-        pipe.hmset(self.__key(_id), saveDict )
+        self.__write(pipe, _id, saveDict)
         #add the id to the master object list
         pipe.zadd(self.__classKey(), **{str(_id): float(_id)})
 
@@ -251,6 +467,7 @@ class IndexedObject(Rediston):
 
 
 
+    @timed('object.update')
     def update(self, **keyValues):
         """
         Set a field(s) in the object and save it to the database
@@ -260,20 +477,37 @@ class IndexedObject(Rediston):
         if not self.id:
             raise ValueError("Cannot update a value for an unsaved object")
 
-        #set the data in redis
-        ret = self._getConnection('master').hmset(self.__key(self.id), keyValues )
+        updateAbleKeys = self._keySpec.findKeysForUpdate(tuple(sorted(keyValues)))
+        #remember the current index entries, so we can remove the ones the new values make stale
+        oldEntries = [(k, self._indexEntries(k)) for k in updateAbleKeys]
 
-        #update the keys
-        updateAbleKeys = self._keySpec.findKeysForUpdate(keyValues.iterkeys())
-        for k in updateAbleKeys:
-            k.update(self, keyValues)
+        #set the data in redis
+        ret = self.__write(self._getConnection('master'), self.id, keyValues)
 
         #set the data in the object (after successful redis update, to avoid invalid objects)
         for k, v in keyValues.iteritems():
             setattr(self, k, v)
 
+        #update the keys
+        if oldEntries:
+            pipe = self._getPipeline('master')
+            for k, old in oldEntries:
+                current = set((e[0], e[1]) for e in self._indexEntries(k))
+                k.remove([e for e in old if (e[0], e[1]) not in current], pipe)
+                k.update(self, pipe)
+            pipe.execute()
+
         return ret
 
+    def _indexEntries(self, key):
+        """
+        Get the entries the object should have in a key, or an empty list if it lacks the fields the key needs
+        """
+        try:
+            return key.entries(self)
+        except (KeyError, ValueError, TypeError):
+            return []
+
 
     @classmethod
     def incrementWhere(cls, condition, fieldName, amount):
@@ -285,7 +519,7 @@ class IndexedObject(Rediston):
         ids = cls.find(condition)
         pipe = cls._getPipeline('master')
         for id in ids:
-            pipe.hincrby(cls.__key(id), fieldName, amount)
+            pipe.hincrby(cls.__key(id), cls._hashFields((fieldName,))[0], amount)
 
         #execute the pipe and get the new values
         newVals = pipe.execute()
@@ -293,12 +527,13 @@ class IndexedObject(Rediston):
         #udpate the keys
         updateAbleKeys = cls._keySpec.findKeysForUpdate((fieldName,))
         for key in updateAbleKeys:
-            key.updateMany(((id, newVals[idx]) for idx, id in enumerate(ids)))
+            key.updateMany(ids, cls)
 
 
         return [(id, newVals[idx]) for idx, id in enumerate(ids)]
 
     @classmethod
+    @timed('object.updatewhere')
     def updateWhere(cls, condition, **keyValues):
         """
         Update fields with new values for objects matching a condition
@@ -307,15 +542,15 @@ class IndexedObject(Rediston):
         pipe = cls._getPipeline('master')
         #update the database
         for id in ids:
-            pipe.hmset(cls.__key(id), keyValues)
+            cls.__write(pipe, id, keyValues)
 
         #execute the pipe and get the new values
         res = pipe.execute()
 
         #udpate the keys
-        updateAbleKeys = cls.__keySpec.findKeysForUpdate(keyValues.iterkeys())
+        updateAbleKeys = cls._keySpec.findKeysForUpdate(tuple(sorted(keyValues)))
         for key in updateAbleKeys:
-            key.updateMany(((id, keyValues) for ids in ids))
+            key.updateMany(ids, cls)
 
         return ids
 
@@ -324,6 +559,7 @@ class IndexedObject(Rediston):
         """
         Load a class by a named key indexing some if its fields
         value can by a multiple token string
+        @param fields optional list of fields to load if you do not want ALL the object
         """
 
         ids = cls.find(condition)
@@ -331,6 +567,7 @@ class IndexedObject(Rediston):
         return cls.loadObjects(ids, *fields )
 
     @classmethod
+    @timed('object.find')
     def find(cls, condition):
         """
         Find object ids for a given condition
@@ -338,13 +575,74 @@ class IndexedObject(Rediston):
 
         key = cls._keySpec.getKey(condition)
 
-        ids = key.find(condition)
+        if key.needsVerification:
+            ids = cls.__findVerified(key, condition)
+        else:
+            ids = key.find(condition)
 
-        logging.debug("Ids for %s: %s", condition, ids)
+        if util.DEBUG:
+            logging.debug("Ids for %s: %s", condition, ids)
         return ids
 
+    @classmethod
+    @timed('object.count')
+    def count(cls, condition):
+        """
+        Count the objects matching a condition. for numeric and compound keys this does not fetch any ids
+        """
+        key = cls._keySpec.getKey(condition)
+
+        if key.needsVerification:
+            return len(cls.find(condition))
+
+        return key.count(condition)
+
+    @classmethod
+    def __findVerified(cls, key, condition):
+        """
+        Find and verify ids with a key that can return false positives. Pages are verified before they are cut, or false
+        positives would leave them short, so candidates are fetched in growing windows until the page is full
+        """
+        if not condition.paging:
+            return cls.__verify(key.find(condition), key, condition)
+
+        start, num = condition.paging
+        verified = []
+        offset = 0
+        window = start + num + cls._verifySlack
+        while len(verified) < start + num:
+            candidates = key.find(Condition(condition.fieldsAndValues, paging=(offset, window), order=condition.order))
+            verified.extend(cls.__verify(candidates, key, condition))
+            if len(candidates) < window:
+                break
+            offset += window
+            window *= 2
+
+        return verified[start:start + num]
 
     @classmethod
+    def __verify(cls, ids, key, condition):
+        """
+        Filter out ids whose objects do not actually match the condition's values for the key fields.
+        Used for keys that can return false positives, e.g. hash collisions in UnorderedKey
+        """
+        #compare with the bytes redis returns: unicode is stored as UTF-8, like the keys hash it
+        expected = [v.encode('utf-8') if isinstance(v, unicode) else '%s' % v
+                    for v in condition.getValuesFor(*key.fields)]
+        hashFields = cls._hashFields(key.fields)
+
+        ret = []
+        for start in xrange(0, len(ids), cls._loadChunkSize):
+            chunk = ids[start:start + cls._loadChunkSize]
+            p = cls._getPipeline()
+            [p.hmget(cls.__key(id), hashFields) for id in chunk]
+            ret.extend(id for id, vals in zip(chunk, p.execute()) if vals == expected)
+
+        return ret
+
+
+    @classmethod
+    @timed('object.delete')
     def delete(cls, condition):
         """
         Delete multiple objects by condition
@@ -354,7 +652,29 @@ class IndexedObject(Rediston):
         ids = cls.find(condition)
 
         if ids:
-            conn = cls._getConnection('master')
-            conn.delete(*[cls.__key(id) for id in ids])
+            pipe = cls._getPipeline('master')
+
+            #remove the objects from all the keys, so no stale entries are left behind
+            for obj in cls.loadObjects(ids, keepMissing=False):
+                for k in cls._keySpec.keys():
+                    k.remove(obj._indexEntries(k), pipe)
+
+            pipe.delete(*[cls.__key(id) for id in ids])
+            pipe.zrem(cls.__classKey(), *ids)
+            pipe.execute()
         
-        return len(ids) if ids else 0
\ No newline at end of file
+        return len(ids) if ids else 0
+
+    @classmethod
+    def _objectKey(cls, id):
+        """
+        The redis key of an object's hash. use '*' as id to get a pattern matching all the objects of the class
+        """
+        return cls.__key(id)
+
+    @classmethod
+    def _idsKey(cls):
+        """
+        The redis key of the sorted set of all the object ids of the class
+        """
+        return cls.__classKey()
\ No newline at end of file
@@ -0,0 +1,179 @@
+#Copyright 2012 Do@. All rights reserved.
+#
+#Redistribution and use in source and binary forms, with or without modification, are
+#permitted provided that the following conditions are met:
+#
+#   1. Redistributions of source code must retain the above copyright notice, this list of
+#      conditions and the following disclaimer.
+#
+#   2. Redistributions in binary form must reproduce the above copyright notice, this list
+#      of conditions and the following disclaimer in the documentation and/or other materials
+#      provided with the distribution.
+#
+#THIS SOFTWARE IS PROVIDED BY Do@ ``AS IS'' AND ANY EXPRESS OR IMPLIED
+#WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> OR
+#CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+#CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+#ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+#NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+#ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#The views and conclusions contained in the software and documentation are those of the
+#authors and should not be interpreted as representing official policies, either expressed
+#or implied, of Do@.
+
+from __future__ import absolute_import
+__author__ = 'dvirsky'
+
+from .redis_unit import RedisDataTest
+import heapq
+import random
+import re
+import sys
+
+
+class RedisMemoryProfiler(RedisDataTest):
+    """
+    Attributes redis memory to the key families created by this library (bitmap counters, indexes, objects, etc).
+    It walks the keys with SCAN, optionally sampling them, and gets their size with MEMORY USAGE and their type and
+    encoding with TYPE and OBJECT ENCODING, in paced, pipelined chunks - so it is safe to run on production.
+    Requires redis 4.0 or higher for MEMORY USAGE.
+    Example:
+    >>> profiler = RedisMemoryProfiler('localhost', 6379, chunkSize=500, pause=0.01)
+    >>> profiler.printReport(profiler.profile(sample=0.1))
+    """
+
+    #(family, regex) pairs, checked in order. the first group of the regex, if any, sub-divides the family
+    FAMILIES = (
+        #temporary results of expressions, retention and backfills, before the caches that share their prefixes
+        ('temp', re.compile(r'^(tk|aggregate|cohort|funnel|segment|backfill|retention:tmp):')),
+        ('bitmap_counter', re.compile(r'^uc:([^:]+):')),
+        ('bitmap_counts', re.compile(r'^count:([^:]+):')),
+        ('retention_cache', re.compile(r'^retention:([^:]+):')),
+        #the reverse mapping buckets are grouped under their prefix
+        ('id_mapper', re.compile(r'^idmap:([^:]+)')),
+        ('id_generator', re.compile(r'^:(.+):idgen')),
+        ('full_text_key', re.compile(r'^ft:([^:]+):')),
+        ('unordered_key', re.compile(r'^k:(.+)$')),
+        ('lexical_key', re.compile(r'^lk:(.+)$')),
+        ('ordered_key', re.compile(r'^ok:(.+)$')),
+        ('unique_key', re.compile(r'^uk:(.+)$')),
+        ('compound_key', re.compile(r'^ck:([^/]+/[^/]+)/')),
+        ('object_ids', re.compile(r'^ids:(.+)$')),
+        ('objects', re.compile(r'^([^:]+):\d+$')),
+    )
+
+    OTHER = 'other'
+
+    #how many elements MEMORY USAGE samples in aggregate types
+    MEMORY_SAMPLES = 5
+
+    def classify(self, key):
+        """
+        Get the family of a key
+        @return a (family, detail) tuple, e.g. ('bitmap_counter', 'dau')
+        """
+        for family, exp in self.FAMILIES:
+            m = exp.match(key)
+            if m:
+                return family, m.group(1) if m.groups() else ''
+
+        return self.OTHER, ''
+
+    def profile(self, pattern = '*', sample = 1.0, top = 20, detailed = True):
+        """
+        Profile the keys matching a pattern
+        @param sample the fraction of the keys to measure. totals are extrapolated from the sample
+        @param top how many of the biggest keys to report
+        @param detailed if True, families are divided by their sub-name, e.g. per metric or per index
+        @return a dict with per family totals, the top keys, and the numbers of keys scanned and sampled
+        """
+        families = {}
+        biggest = []
+        #a list, so the generator below can count into it
+        scanned = [0]
+        sampled = 0
+
+        def sampledKeys():
+            for k in self.scanKeys(pattern):
+                scanned[0] += 1
+                if sample >= 1.0 or random.random() < sample:
+                    yield k
+
+        for chunk in self._chunks(sampledKeys()):
+            p = self.redis.pipeline(transaction=False)
+            for k in chunk:
+                p.type(k)
+                p.object('encoding', k)
+                p.execute_command('MEMORY', 'USAGE', k, 'SAMPLES', self.MEMORY_SAMPLES)
+            replies = p.execute(raise_on_error=False)
+
+            for idx, k in enumerate(chunk):
+                ktype, encoding, size = replies[3 * idx: 3 * idx + 3]
+                #the key expired or was deleted since we scanned it
+                if ktype == 'none' or isinstance(size, Exception) or size is None:
+                    continue
+
+                family, detail = self.classify(k)
+                name = '%s:%s' % (family, detail) if detailed and detail else family
+
+                stats = families.setdefault(name, {'keys': 0, 'bytes': 0, 'types': {}, 'encodings': {}})
+                stats['keys'] += 1
+                stats['bytes'] += size
+                stats['types'][ktype] = stats['types'].get(ktype, 0) + 1
+                if not isinstance(encoding, Exception):
+                    stats['encodings'][encoding] = stats['encodings'].get(encoding, 0) + 1
+
+                if len(biggest) < top:
+                    heapq.heappush(biggest, (size, k, name, ktype, encoding))
+                else:
+                    heapq.heappushpop(biggest, (size, k, name, ktype, encoding))
+
+                sampled += 1
+
+        #extrapolate from the sample
+        if sample < 1.0:
+            for stats in families.itervalues():
+                stats['estimatedKeys'] = int(stats['keys'] / sample)
+                stats['estimatedBytes'] = int(stats['bytes'] / sample)
+
+        return {
+            'families': families,
+            'top': sorted(biggest, reverse=True),
+            'scanned': scanned[0],
+            'sampled': sampled,
+            'sample': sample,
+        }
+
+    def printReport(self, profile, out = sys.stdout):
+        """
+        Print a profile as human readable tables, biggest families first
+        """
+        estimated = profile['sample'] < 1.0
+        bytesField, keysField = ('estimatedBytes', 'estimatedKeys') if estimated else ('bytes', 'keys')
+
+        out.write('Scanned %d keys, sampled %d (%.01f%%)\n\n' % (profile['scanned'], profile['sampled'],
+                                                                100 * profile['sample']))
+        out.write('%-50s %12s %14s %10s  %s\n' % ('family', 'keys', 'bytes', 'avg', 'encodings'))
+
+        families = sorted(profile['families'].iteritems(), key=lambda x: x[1][bytesField], reverse=True)
+        for name, stats in families:
+            out.write('%-50s %12d %14d %10d  %s\n' % (name, stats[keysField], stats[bytesField],
+                                                      stats['bytes'] / stats['keys'],
+                                                      ', '.join('%s:%d' % e for e in stats['encodings'].iteritems())))
+
+        out.write('\nTop keys:\n')
+        for size, k, name, ktype, encoding in profile['top']:
+            out.write('%12d  %-60s %s (%s/%s)\n' % (size, k, name, ktype, encoding))
+
+
+if __name__ == '__main__':
+
+    host = sys.argv[1] if len(sys.argv) > 1 else 'localhost'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 6379
+    sample = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+
+    profiler = RedisMemoryProfiler(host, port, verbose=False)
+    profiler.printReport(profiler.profile(sample=sample))
@@ -31,6 +31,11 @@ import redis
 import sys
 import contextlib
 import re
+import time
+import json
+import traceback
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import quoteattr
 
 class RedisAssertionError(Exception):
 
@@ -57,6 +62,20 @@ class RedisDataTest(object):
     T_LIST = 'list'
     T_SET = 'set'
 
+    #test result statuses
+    S_PASS = 'pass'
+    S_FAIL = 'fail'
+    S_ERROR = 'error'
+
+    #the command that gets the size of each type
+    SIZE_COMMANDS = {
+        T_STRING: 'strlen',
+        T_HASH: 'hlen',
+        T_ZSET: 'zcard',
+        T_LIST: 'llen',
+        T_SET: 'scard',
+    }
+
     ############################################################################################
     ## Static methods below are used to validate values of keys by applying lambdas on them
     # Example: test.assertKeyValue('foo', RedisDataTest.greaterThan(0)) => asserts that the value in 'foo' > 0
@@ -94,12 +113,41 @@ class RedisDataTest(object):
     #########################################
 
 
-    def __init__(self, host = 'localhost', port = 6379, db = 0, timeout = None, verbose = True):
+    def __init__(self, host = 'localhost', port = 6379, db = 0, timeout = None, verbose = True, chunkSize = 1000, pause = 0):
         """
         @param verbose whether we want to output messages or not
+        @param chunkSize how many keys are checked in each pipeline, also used as the SCAN COUNT hint
+        @param pause seconds to sleep between chunks, to limit the load when testing production databases
         """
         self.redis = redis.Redis(host, port, db, timeout)
         self.verbose = verbose
+        self.chunkSize = chunkSize
+        self.pause = pause
+
+    def _chunks(self, keys):
+        """
+        Split an iterable of keys to lists of chunkSize, pausing between them
+        """
+        chunk = []
+        for k in keys:
+            chunk.append(k)
+            if len(chunk) >= self.chunkSize:
+                yield chunk
+                chunk = []
+                if self.pause:
+                    time.sleep(self.pause)
+        if chunk:
+            yield chunk
+
+    def scanKeys(self, pattern, maxKeys = None):
+        """
+        Iterate the keys matching a pattern with SCAN, without blocking redis
+        @param maxKeys if set, stop after this many keys, to test a sample of the keys
+        """
+        for idx, k in enumerate(self.redis.scan_iter(match=pattern, count=self.chunkSize)):
+            if maxKeys is not None and idx >= maxKeys:
+                return
+            yield k
 
     @contextlib.contextmanager
     def _message(self, msg, *args):
@@ -122,11 +170,12 @@ class RedisDataTest(object):
         """
 
         with self._message("Asserting the existence of %s (%d keys)...", keys[:5], len(keys)):
-            p = self.redis.pipeline()
-            [p.exists(k) for k in keys]
-            for idx, exists in enumerate(p.execute()):
-                if not exists:
-                    raise RedisAssertionError("Key %s does not exist" % keys[idx])
+            for chunk in self._chunks(keys):
+                p = self.redis.pipeline(transaction=False)
+                [p.exists(k) for k in chunk]
+                for idx, exists in enumerate(p.execute()):
+                    if not exists:
+                        raise RedisAssertionError("Key %s does not exist" % chunk[idx])
 
 
     def assertKeysType(self,  ktype, *keys):
@@ -136,26 +185,24 @@ class RedisDataTest(object):
         """
 
         with self._message("Testing if '%s (%d keys)' is of type %s", keys[:5], len(keys), ktype):
-            p = self.redis.pipeline()
-            [p.type(k) for k in keys]
-            for idx, t in enumerate(p.execute()):
-                if not t==ktype:
-                    raise RedisAssertionError("Key %s is of type %s - expected %s" % (keys[idx], t, ktype))
+            for chunk in self._chunks(keys):
+                p = self.redis.pipeline(transaction=False)
+                [p.type(k) for k in chunk]
+                for idx, t in enumerate(p.execute()):
+                    if not t==ktype:
+                        raise RedisAssertionError("Key %s is of type %s - expected %s" % (chunk[idx], t, ktype))
 
     def countPrefix(self, prefix):
         """
-        Return the number of keys in a prefix
-        @warning: DO NOT USE IN PRODUCTION DATABASES!
+        Return the number of keys in a prefix. It uses SCAN, so it doesn't block redis, but it does walk the whole keyspace
         """
-        keys = self.redis.keys(prefix)
-        return len(keys)
+        return sum(1 for k in self.scanKeys(prefix))
 
 
     def assertPrefixCount(self, prefix, minAmount, maxAmount = None):
         """
         Check that a prefix does not appear more than maxAmount times and no less of minAmount times
         @param prefix - the prefix to be tested
-        @warning: DO NOT USE IN PRODUCTION DATABASES!
         """
         with self._message("Assering that keys with prefix '%s' are between %s and %s", prefix, minAmount, maxAmount or 'infinity'):
             num = self.countPrefix(prefix)
@@ -165,6 +212,65 @@ class RedisDataTest(object):
                 raise RedisAssertionError("Expected at most %d elements for '%s', got %d", maxAmount, prefix, num)
 
 
+    def assertPattern(self, pattern, ktype = None, hashFields = (), hasTTL = None, minSize = None, maxSize = None,
+                      maxKeys = None):
+        """
+        Make assertions about all the keys matching a pattern. The keys are streamed with SCAN and checked in pipelined
+        chunks, so this is safe to run against production databases
+        @param pattern a SCAN MATCH pattern, e.g. 'users:*'
+        @param ktype if set, all the keys must be of this type (use the T_* constants)
+        @param hashFields if set, all the keys must be hashes containing these fields
+        @param hasTTL if True, all the keys must have a TTL. if False, none of them may have one
+        @param minSize, maxSize if set, the size of each key (length, cardinality, etc) must be within these bounds
+        @param maxKeys if set, only check this many keys - useful for sampling huge prefixes
+        @return the number of keys checked
+        """
+        checkSize = minSize is not None or maxSize is not None
+        numKeys = 0
+
+        with self._message("Checking keys matching '%s'", pattern):
+            for chunk in self._chunks(self.scanKeys(pattern, maxKeys)):
+                p = self.redis.pipeline(transaction=False)
+                for k in chunk:
+                    p.type(k)
+                    p.ttl(k)
+                    [p.hexists(k, f) for f in hashFields]
+                #HEXISTS fails on keys of other types, which we report as missing fields
+                replies = p.execute(raise_on_error=False)
+
+                step = 2 + len(hashFields)
+                types = replies[0::step]
+                for idx, k in enumerate(chunk):
+                    t, ttl = types[idx], replies[idx * step + 1]
+
+                    if ktype is not None and t != ktype:
+                        raise RedisAssertionError("Key %s is of type %s - expected %s", k, t, ktype)
+
+                    missing = [f for i, f in enumerate(hashFields)
+                               if isinstance(replies[idx * step + 2 + i], Exception) or not replies[idx * step + 2 + i]]
+                    if missing:
+                        raise RedisAssertionError("Fields %s of hash %s do not exist!", missing, k)
+
+                    keyHasTTL = ttl is not None and ttl >= 0
+                    if hasTTL is not None and keyHasTTL != hasTTL:
+                        raise RedisAssertionError("Key %s has TTL %s - expected %s", k, ttl, 'a TTL' if hasTTL else 'no TTL')
+
+                if checkSize:
+                    #the size command depends on the type, so the sizes need a second round-trip
+                    p = self.redis.pipeline(transaction=False)
+                    for idx, k in enumerate(chunk):
+                        p.execute_command(self.SIZE_COMMANDS.get(types[idx], 'strlen'), k)
+
+                    for k, num in zip(chunk, p.execute()):
+                        if minSize is not None and num < minSize:
+                            raise RedisAssertionError("Expected at least %d elements for '%s', got %d", minSize, k, num)
+                        elif maxSize is not None and num > maxSize:
+                            raise RedisAssertionError("Expected at most %d elements for '%s', got %d", maxSize, k, num)
+
+                numKeys += len(chunk)
+
+        return numKeys
+
     def assertListSize(self, key, min, max = None):
         """
         Assert the size of a LIST is between min and max. if max is none only min applies
@@ -265,17 +371,108 @@ class RedisDataTest(object):
                 raise RedisAssertionError("value %s in sorted set %s has rank of %s, expected %s", value, key, rank, assertRank)
 
 
-    def run(self):
+    def _testNames(self):
+        """
+        Get the names of all the test* methods, sorted
+        """
+        names = set()
+        for cls in self.__class__.__mro__:
+            names.update(name for name, member in cls.__dict__.iteritems() if name.startswith('test') and callable(member))
+        return sorted(names)
+
+    def _runTest(self, name):
+        """
+        Run a single test, catching its failure
+        @return a dict with the test's name, status (pass/fail/error), duration in seconds and failure message
+        """
+        st = time.time()
+        status, message = self.S_PASS, None
+        try:
+            getattr(self, name)()
+        except RedisAssertionError, e:
+            status, message = self.S_FAIL, str(e)
+        except Exception, e:
+            status, message = self.S_ERROR, traceback.format_exc()
+
+        return {'name': name, 'status': status, 'duration': time.time() - st, 'message': message}
+
+    @classmethod
+    def hasFailures(cls, results):
+        """
+        Check if any of the results returned by run() did not pass
+        """
+        return any(r['status'] != cls.S_PASS for r in results)
 
+    def run(self, workers = 1, report = None, raiseOnFailure = True):
         """
-        Run all functions that start with test*
+        Run all functions that start with test*, each isolated from the failures of the others
+        @param workers how many tests to run concurrently. redis connections are taken from the connection pool,
+        so each worker uses its own connection
+        @param report optional path to write a machine readable report to. a path ending with .xml gets a JUnit XML
+        report, anything else gets JSON
+        @param raiseOnFailure if True, a RedisAssertionError is raised after the report is written if any test did not
+        pass. otherwise check the results with hasFailures()
+        @return a list of result dicts, see _runTest
         """
+        names = self._testNames()
+        st = time.time()
+
+        if workers > 1:
+            #assertion messages of concurrent tests would get mixed up, so we only print per test results
+            verbose, self.verbose = self.verbose, False
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(self._runTest, names)
+            finally:
+                pool.close()
+                self.verbose = verbose
+        else:
+            results = [self._runTest(name) for name in names]
+
+        duration = time.time() - st
 
-        for memberName, member in self.__class__.__dict__.iteritems():
+        if self.verbose:
+            for r in results:
+                sys.stderr.write('%s\t[%s]\t%.03fs\n' % (r['name'], r['status'].upper(), r['duration']))
+                if r['message']:
+                    sys.stderr.write('\t%s\n' % r['message'])
+            failed = sum(1 for r in results if r['status'] != self.S_PASS)
+            sys.stderr.write('Ran %d tests in %.03fs, %d failed\n' % (len(results), duration, failed))
+
+        if report:
+            with open(report, 'w') as fp:
+                if report.endswith('.xml'):
+                    fp.write(self._junitReport(results, duration))
+                else:
+                    json.dump({'suite': self.__class__.__name__, 'duration': duration, 'tests': results}, fp, indent=2)
+
+        if raiseOnFailure and self.hasFailures(results):
+            raise RedisAssertionError("%d of %d tests failed: %s", sum(1 for r in results if r['status'] != self.S_PASS),
+                                      len(results), ', '.join(r['name'] for r in results if r['status'] != self.S_PASS))
+
+        return results
+
+    def _junitReport(self, results, duration):
+        """
+        Format test results as a JUnit XML report
+        """
+        suite = self.__class__.__name__
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<testsuite name=%s tests="%d" failures="%d" errors="%d" time="%.03f">' % (
+                     quoteattr(suite), len(results),
+                     sum(1 for r in results if r['status'] == self.S_FAIL),
+                     sum(1 for r in results if r['status'] == self.S_ERROR),
+                     duration)]
 
-            if memberName.startswith('test') and callable(member):
+        for r in results:
+            lines.append('  <testcase classname=%s name=%s time="%.03f">' % (quoteattr(suite), quoteattr(r['name']), r['duration']))
+            if r['status'] != self.S_PASS:
+                tag = 'failure' if r['status'] == self.S_FAIL else 'error'
+                lines.append('    <%s message=%s/>' % (tag, quoteattr(r['message'] or '')))
+            lines.append('  </testcase>')
 
-                getattr(self, memberName)()
+        lines.append('</testsuite>')
+        return '\n'.join(lines) + '\n'
 
 
 if __name__ == '__main__':
@@ -288,4 +485,5 @@ if __name__ == '__main__':
 
 
     t = MyTest()
-    t.run()
\ No newline at end of file
+    results = t.run(raiseOnFailure = False)
+    sys.exit(1 if MyTest.hasFailures(results) else 0)
\ No newline at end of file
@@ -40,18 +40,28 @@ Created on Sep 21, 2011
 
 import redis
 
+from .instrumentation import InstrumentedConnection
+
+
+#Set to True to log the internals of the hot paths (keys chosen for queries, index values, id mappings).
+#They are called too often to pay for a logging call each time otherwise
+DEBUG = False
+
 
 class Rediston(object):
     """
     This is a base class that holds a connection pool and redis connection instances
     """
 
+    __slots__ = ()
+
     __connPool = None
 
     _host = 'localhost'
     _port = 6379
     _db = 0
     _timeout = None
+    _connectionClass = InstrumentedConnection
 
     @classmethod
     def _getConnection(cls, mode = 'master'):
@@ -64,6 +74,7 @@ class Rediston(object):
                 port = cls._port,
                 db = cls._db,
                 socket_timeout = cls._timeout,
+                connection_class = cls._connectionClass,
             )
 
         if not cls.redis:
@@ -83,12 +94,17 @@ class Rediston(object):
 
 
     @classmethod
-    def config(cls, host, port, db, timeout = None):
+    def config(cls, host, port, db, timeout = None, connectionClass = None):
+        """
+        @param connectionClass the class of the pool's connections, e.g. lua.ScriptLoadingConnection.
+        defaults to InstrumentedConnection
+        """
 
         cls._host = host
         cls._port = port
         cls._db = db
         cls._timeout = timeout
+        cls._connectionClass = connectionClass or InstrumentedConnection
 
 
         cls.__connPool = None